@@ -1,26 +1,31 @@
 import logging
 import asyncio
+import time
+from dataclasses import dataclass, field
+from string import Template
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Iterator, Optional
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, filters
 from telegram.constants import ParseMode
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, desc, or_
 from collections import defaultdict
 
 from database import (
+    User,
+    Subscription,
+    Download,
+    Payment,
+    PaymentStatus,
     get_user,
-    get_user_subscription,
-    get_all_users,
     get_all_payments,
     complete_payment,
     update_subscription_plan,
     get_user_downloads,
-    get_all_downloads,
     get_user_payments
 )
-from config import PLAN_LIMITS, SubscriptionPlans
+from config import PLAN_LIMITS, STATS_CACHE_TTL, STATS_REFRESH_INTERVAL, SubscriptionPlans
 from utils.helpers import format_price, format_timedelta
 
 # Configure logging
@@ -30,6 +35,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Static keyboards, built once and shared by all messages
+ADMIN_PANEL_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 آمار کاربران", callback_data="admin_stats"),
+        InlineKeyboardButton("💳 مدیریت پرداخت‌ها", callback_data="admin_payments")
+    ],
+    [
+        InlineKeyboardButton("📥 مدیریت دانلودها", callback_data="admin_downloads"),
+        InlineKeyboardButton("📢 ارسال پیام همگانی", callback_data="admin_broadcast")
+    ],
+    [
+        InlineKeyboardButton("🔙 منوی اصلی", callback_data="start")
+    ]
+])
+ADMIN_BACK_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 بازگشت به پنل مدیریت", callback_data="admin")]
+])
+
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show admin panel"""
@@ -40,50 +63,43 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔️ دسترسی ممنوع!")
         return
     
-    # Get stats
+    # Get stats; only fetch the numbers shown instead of whole tables
     db = context.bot_data["db"]
-    users = get_all_users(db)
-    payments = get_all_payments(db)
-    downloads = get_all_downloads(db)
     
     # Calculate stats
-    total_users = len(users)
-    active_subscriptions = sum(1 for user in users if get_user_subscription(db, user.id) and get_user_subscription(db, user.id).is_active)
-    total_earnings = sum(p.amount for p in payments if p.status == "completed")
-    total_downloads = len(downloads)
+    total_users = db.query(func.count(User.id)).scalar()
+    active_subscriptions = db.query(func.count(func.distinct(Subscription.user_id))).filter(
+        Subscription.is_active == True,
+        or_(Subscription.end_date.is_(None), Subscription.end_date > datetime.utcnow())
+    ).scalar()
+    total_earnings = db.query(func.coalesce(func.sum(Payment.amount), 0)).filter(
+        Payment.status == PaymentStatus.COMPLETED
+    ).scalar()
+    total_downloads = db.query(func.count(Download.id)).scalar()
     
     # Prepare message
-    text = f"👑 *پنل مدیریت*\n\n"
-    text += f"👥 تعداد کاربران: {total_user}\n"
-    text += f"✅ اشتراک‌های فعال: {active_subscriptions}\n"
-    text += f"💰 درآمد کل: {format_price(total_earnings)} تومان\n"
-    text += f"📥 تعداد کل دانلودها: {total_downloads}\n\n"
+    parts = [
+        "👑 *پنل مدیریت*\n\n",
+        f"👥 تعداد کاربران: {total_users}\n",
+        f"✅ اشتراک‌های فعال: {active_subscriptions}\n",
+        f"💰 درآمد کل: {format_price(total_earnings)} تومان\n",
+        f"📥 تعداد کل دانلودها: {total_downloads}\n\n",
+    ]
     
     # Add recent payments
-    recent_payments = sorted([p for p in payments if p.status == "completed"], key=lambda x: x.payment_date, reverse=True)[:5]
+    recent_payments = db.query(Payment).options(joinedload(Payment.user)).filter(
+        Payment.status == PaymentStatus.COMPLETED
+    ).order_by(desc(Payment.payment_date)).limit(5).all()
     if recent_payments:
-        text += "💳 *آخرین پرداخت‌ها:*\n"
+        parts.append("💳 *آخرین پرداخت‌ها:*\n")
         for i, payment in enumerate(recent_payments, 1):
-            user = get_user(db, payment.user_id)
+            user = payment.user
             username = f"@{user.username}" if user.username else f"کاربر #{user.telegram_id}"
-            text += f"{i}. {username} - {format_price(payment.amount)} تومان ({payment.plan})\n"
+            parts.append(f"{i}. {username} - {format_price(payment.amount)} تومان ({payment.plan})\n")
     
-    # Create inline keyboard
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 آمار کاربران", callback_data="admin_stats"),
-            InlineKeyboardButton("💳 مدیریت پرداخت‌ها", callback_data="admin_payments")
-        ],
-        [
-            InlineKeyboardButton("📥 مدیریت دانلودها", callback_data="admin_downloads"),
-            InlineKeyboardButton("📢 ارسال پیام همگانی", callback_data="admin_broadcast")
-        ],
-        [
-            InlineKeyboardButton("🔙 منوی اصلی", callback_data="start")
-        ]
-    ]
+    text = "".join(parts)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ADMIN_PANEL_KEYBOARD
     
     # Send or update message
     if update.callback_query:
@@ -105,44 +121,45 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    # Get all users
     db = context.bot_data["db"]
-    users = get_all_users(db)
-    
-    # Calculate stats
-    total_users = len(users)
-    
-    # Group by subscription plan
-    plan_counts = {}
-    active_subscriptions = 0
-    for user in users:
-        sub = get_user_subscription(db, user.id)
-        if sub and sub.is_active:
-            active_subscriptions += 1
-            plan_name = sub.plan
-            plan_counts[plan_name] = plan_counts.get(plan_name, 0) + 1
+    now = datetime.utcnow()
+    week_ago = now - timedelta(days=7)
+    
+    # Count users and new users (last 7 days) in one query
+    total_users, new_users = db.query(
+        func.count(User.id),
+        func.count(User.id).filter(User.join_date >= week_ago)
+    ).one()
+    
+    # Group active subscriptions by plan in the database
+    plan_counts = dict(
+        db.query(Subscription.plan, func.count(func.distinct(Subscription.user_id))).filter(
+            Subscription.is_active == True,
+            or_(Subscription.end_date.is_(None), Subscription.end_date > now)
+        ).group_by(Subscription.plan).all()
+    )
+    active_subscriptions = sum(plan_counts.values())
     
     # Prepare message
-    text = "📊 *آمار کاربران*\n\n"
-    text += f"👥 تعداد کل کاربران: {total_user}\n"
-    text += f"✅ اشتراک‌های فعال: {active_subscriptions}\n\n"
+    parts = [
+        "📊 *آمار کاربران*\n\n",
+        f"👥 تعداد کل کاربران: {total_users}\n",
+        f"✅ اشتراک‌های فعال: {active_subscriptions}\n\n",
+        "📊 توزیع پلن‌ها:\n",
+    ]
     
     # Add plan distribution
-    text += "📊 توزیع پلن‌ها:\n"
-    for plan, count in plan_counts.items():
-        text += f"• {plan}: {count} کاربر ({count/total_users*100:.1f}%)\n"
+    parts.extend(
+        f"• {plan}: {count} کاربر ({count/total_users*100:.1f}%)\n"
+        for plan, count in plan_counts.items()
+    )
     
     # Add user growth (last 7 days)
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    new_users = sum(1 for user in users if user.join_date >= week_ago)
-    text += f"\n📈 کاربران جدید (۷ روز اخیر): {new_users}"
+    parts.append(f"\n📈 کاربران جدید (۷ روز اخیر): {new_users}")
     
-    # Create back button
-    keyboard = [
-        [InlineKeyboardButton("🔙 بازگشت به پنل مدیریت", callback_data="admin")]
-    ]
+    text = "".join(parts)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ADMIN_BACK_KEYBOARD
     
     # Update message
     await query.message.edit_text(
@@ -162,19 +179,23 @@ async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pending_payments = [p for p in payments if p.status == "pending"]
     
     # Prepare message
-    text = "💳 *مدیریت پرداخت‌ها*\n\n"
+    parts = ["💳 *مدیریت پرداخت‌ها*\n\n"]
     
     if not pending_payments:
-        text += "هیچ پرداخت در انتظار تاییدی وجود ندارد."
+        parts.append("هیچ پرداخت در انتظار تاییدی وجود ندارد.")
     else:
-        text += "🔍 *پرداخت‌های در انتظار تایید:*\n\n"
+        parts.append("🔍 *پرداخت‌های در انتظار تایید:*\n\n")
         for i, payment in enumerate(pending_payments, 1):
             user = get_user(db, payment.user_id)
             username = f"@{user.username}" if user.username else f"کاربر #{user.telegram_id}"
-            text += f"{i}. {username}\n"
-            text += f"   مبلغ: {format_price(payment.amount)} تومان\n"
-            text += f"   پلن: {payment.plan}\n"
-            text += f"   شناسه پرداخت: `{payment.id}`\n\n"
+            parts.append(
+                f"{i}. {username}\n"
+                f"   مبلغ: {format_price(payment.amount)} تومان\n"
+                f"   پلن: {payment.plan}\n"
+                f"   شناسه پرداخت: `{payment.id}`\n\n"
+            )
+    
+    text = "".join(parts)
     
     # Create inline keyboard
     keyboard = []
@@ -203,6 +224,13 @@ async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=ParseMode.MARKDOWN
     )
 
+# Notification sent to the user once an admin confirms their payment
+PAYMENT_CONFIRMED_TEMPLATE = Template(
+    "✅ پرداخت شما با موفقیت تایید شد!\n\n"
+    "اشتراک ${plan} شما فعال شد.\n"
+    "لطفا از منوی اصلی گزینه 'وضعیت اشتراک' را انتخاب کنید."
+)
+
 async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Confirm a payment"""
     query = update.callback_query
@@ -219,39 +247,43 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         payment = complete_payment(
             db=db,
             payment_id=payment_id,
-            transaction_id=f"MANUAL-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+            transaction_id=f"MANUAL-{payment_id}-{int(time.time())}"
         )
         
         if not payment:
-            raise ValueError("Payment not found")
+            await query.answer("⚠️ این پرداخت یافت نشد یا قبلا تایید شده است.", show_alert=True)
+            return
         
         # Get user info
-        user = get_user(db, payment.user_id)
+        user = payment.user
         
         # Send success message to admin
-        success_text = f"✅ پرداخت با موفقیت تایید شد.\n\n"
-        success_text += f"👤 کاربر: {user.first_name} (@{user.username or 'N/A'})\n"
-        success_text += f"💳 مبلغ: {format_price(payment.amount)} تومان\n"
-        success_text += f"📝 پلن: {payment.plan}\n"
-        success_text += f"🆔 شناسه پرداخت: {payment.id}"
-        
-        await query.message.reply_text(
-            success_text,
-            parse_mode=ParseMode.MARKDOWN
-        )
+        success_text = "\n".join([
+            "✅ پرداخت با موفقیت تایید شد.\n",
+            f"👤 کاربر: {user.first_name} (@{user.username or 'N/A'})",
+            f"💳 مبلغ: {format_price(payment.amount)} تومان",
+            f"📝 پلن: {payment.plan}",
+            f"🆔 شناسه پرداخت: {payment.id}",
+        ])
         
-        # Notify user
-        try:
-            await context.bot.send_message(
+        # Reply to the admin and notify the user at the same time
+        admin_reply, notification = await asyncio.gather(
+            query.message.reply_text(
+                success_text,
+                parse_mode=ParseMode.MARKDOWN
+            ),
+            context.bot.send_message(
                 chat_id=user.telegram_id,
-                text=f"✅ پرداخت شما با موفقیت تایید شد!\n\n"
-                     f"اشتراک {payment.plan} شما فعال شد.\n"
-                     f"لطفا از منوی اصلی گزینه 'وضعیت اشتراک' را انتخاب کنید.",
+                text=PAYMENT_CONFIRMED_TEMPLATE.substitute(plan=payment.plan),
                 parse_mode=ParseMode.MARKDOWN
-            )
-        except Exception as e:
-            logger.error(f"Failed to send notification to user {user.telegram_id}: {e}")
-            await query.message.reply_text(f"⚠️ خطا در ارسال پیام به کاربر: {e}")
+            ),
+            return_exceptions=True
+        )
+        if isinstance(admin_reply, Exception):
+            raise admin_reply
+        if isinstance(notification, Exception):
+            logger.error(f"Failed to send notification to user {user.telegram_id}: {notification}")
+            await query.message.reply_text(f"⚠️ خطا در ارسال پیام به کاربر: {notification}")
         
         # Update payment list
         await admin_payments(update, context)
@@ -260,11 +292,18 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error confirming payment: {e}")
         await query.answer("❌ خطا در تایید پرداخت. لطفا دوباره امتحان کنید.", show_alert=True)
 
+@dataclass
+class _StatsCache:
+    """Rendered /stats text shared between admins until it expires"""
+    text: str = ""
+    expires: float = 0.0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+_stats_cache = _StatsCache()
+
 # Helper functions
 def get_basic_stats(db: Session) -> Dict[str, Any]:
     """Get basic statistics about users, subscriptions, and downloads."""
-    from database import User, Subscription, Download, Payment
-    
     stats = {}
     
     # User counts
@@ -290,35 +329,21 @@ def get_basic_stats(db: Session) -> Dict[str, Any]:
     # Download stats
     stats['total_downloads'] = db.query(Download).count()
     
-    # Downloads by type
-    downloads_by_type = db.query(
-        Download.content_type,
+    # Downloads by status
+    downloads_by_status = db.query(
+        Download.status,
         func.count(Download.id).label('count')
-    ).group_by(Download.content_type).all()
+    ).group_by(Download.status).all()
     
-    stats['downloads_by_type'] = dict(downloads_by_type)
+    stats['downloads_by_status'] = dict(downloads_by_status)
     
     return stats
 
 # Command Handlers
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show bot statistics."""
-    db = next(context.bot_data['db_session_generator']())
     try:
-        stats = get_basic_stats(db)
-        
-        text = ("📊 *آمار ربات*\n\n"
-               f"👥 تعداد کل کاربران: {stats['total_users']:,}\n"
-               f"✅ اشتراک‌های فعال: {stats['active_subscriptions']:,}\n"
-               f"💰 درآمد کل: {format_price(stats['total_earnings'])}\n"
-               f"💳 تعداد پرداخت‌ها: {stats['total_payments']:,}\n"
-               f"📥 تعداد کل دانلودها: {stats['total_downloads']:,}\n\n")
-        
-        # Add downloads by type
-        if stats['downloads_by_type']:
-            text += "📥 *تعداد دانلودها بر اساس نوع:*\n"
-            for content_type, count in stats['downloads_by_type'].items():
-                text += f"  • {content_type}: {count:,}\n"
+        text = await get_stats_text(context)
         
         await update.message.reply_text(
             text,
@@ -328,15 +353,73 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         logger.error(f"Error in stats command: {e}", exc_info=True)
         await update.message.reply_text("❌ خطا در دریافت آمار. لطفاً دوباره تلاش کنید.")
+
+async def get_stats_text(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Return the /stats text, rebuilding it at most once per STATS_CACHE_TTL."""
+    cache = _stats_cache
+    if time.monotonic() < cache.expires:
+        return cache.text
+    
+    async with cache.lock:
+        # Another admin may have refreshed the cache while we waited
+        if time.monotonic() < cache.expires:
+            return cache.text
+        
+        db = next(context.bot_data['db_session_generator']())
+        try:
+            stats = get_basic_stats(db)
+        finally:
+            db.close()
+        
+        _store_stats_text(stats, STATS_CACHE_TTL)
+        return cache.text
+
+def render_stats_text(stats: Dict[str, Any]) -> str:
+    """Render the output of get_basic_stats as the /stats message."""
+    text = ("📊 *آمار ربات*\n\n"
+           f"👥 تعداد کل کاربران: {stats['total_users']:,}\n"
+           f"✅ اشتراک‌های فعال: {stats['active_subscriptions']:,}\n"
+           f"💰 درآمد کل: {format_price(stats['total_earnings'])}\n"
+           f"💳 تعداد پرداخت‌ها: {stats['total_payments']:,}\n"
+           f"📥 تعداد کل دانلودها: {stats['total_downloads']:,}\n\n")
+    
+    # Add downloads by status
+    if stats['downloads_by_status']:
+        text += "📥 *تعداد دانلودها بر اساس وضعیت:*\n"
+        for status, count in stats['downloads_by_status'].items():
+            text += f"  • {status}: {count:,}\n"
+    
+    return text
+
+def _store_stats_text(stats: Dict[str, Any], ttl: float) -> None:
+    _stats_cache.text = render_stats_text(stats)
+    _stats_cache.expires = time.monotonic() + ttl
+
+def _load_basic_stats(session_factory: Callable[[], Session]) -> Dict[str, Any]:
+    db = session_factory()
+    try:
+        return get_basic_stats(db)
     finally:
         db.close()
 
+async def refresh_stats_loop(session_factory: Callable[[], Session]) -> None:
+    """Keep the /stats text warm so admins never wait on the aggregate queries.
+    
+    Each snapshot stays valid for two refresh intervals; if this loop stops,
+    get_stats_text falls back to rebuilding on demand.
+    """
+    while True:
+        try:
+            stats = await asyncio.to_thread(_load_basic_stats, session_factory)
+            _store_stats_text(stats, 2 * STATS_REFRESH_INTERVAL)
+        except Exception as e:
+            logger.error(f"Error refreshing stats: {e}", exc_info=True)
+        await asyncio.sleep(STATS_REFRESH_INTERVAL)
+
 async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List users with pagination."""
     db = next(context.bot_data['db_session_generator']())
     try:
-        from database import User, Subscription
-        
         # Get pagination parameters
         page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
         per_page = 10
@@ -408,20 +491,58 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
     
-    # Ask for confirmation
+    # Send a preview; on confirmation it is copied to every user server-side,
+    # so the full text never has to fit in callback data
     message_text = ' '.join(context.args)
+    preview = await update.message.reply_text(
+        message_text,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    
+    # Ask for confirmation
     keyboard = [
         [
-            InlineKeyboardButton("✅ تایید ارسال", callback_data=f"broadcast_confirm_{message_text[:30]}..."),
+            InlineKeyboardButton(
+                "✅ تایید ارسال",
+                callback_data=f"broadcast_confirm_{preview.chat_id}_{preview.message_id}"
+            ),
             InlineKeyboardButton("❌ انصراف", callback_data="broadcast_cancel")
         ]
     ]
     
-    await update.message.reply_text(
-        f"⚠️ آیا مطمئن هستید که می‌خواهید این پیام را برای همه کاربران ارسال کنید؟\n\n{message_text}",
+    await preview.reply_text(
+        "⚠️ آیا مطمئن هستید که می‌خواهید این پیام را برای همه کاربران ارسال کنید؟",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+# Each send holds a slot for at least a second, keeping broadcasts under
+# Telegram's limit of ~30 messages per second
+BROADCAST_RATE_LIMIT = 25
+# Seconds between progress updates to the admin during a broadcast
+BROADCAST_PROGRESS_INTERVAL = 10
+_broadcast_slots = asyncio.Semaphore(BROADCAST_RATE_LIMIT)
+
+async def _send_broadcast(bot, chat_id: int, from_chat_id: int, message_id: int) -> None:
+    async with _broadcast_slots:
+        started = time.monotonic()
+        await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id
+        )
+        await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+
+async def _broadcast_worker(bot, chat_ids: Iterator[int], from_chat_id: int, message_id: int,
+                            progress: Dict[str, int]) -> None:
+    """Send to chat ids from a shared iterator until it runs out, counting results in progress"""
+    for chat_id in chat_ids:
+        try:
+            await _send_broadcast(bot, chat_id, from_chat_id, message_id)
+        except Exception as e:
+            logger.error(f"Error sending broadcast to user {chat_id}: {e}")
+            progress['failed'] += 1
+        progress['done'] += 1
+
 async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle broadcast confirmation."""
     query = update.callback_query
@@ -431,35 +552,41 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.message.edit_text("❌ ارسال پیام همگانی لغو شد.")
         return
     
-    # Extract message text from callback data
-    message_text = query.data.replace("broadcast_confirm_", "").strip()
+    # Extract the preview message from callback data
+    from_chat_id, message_id = map(int, query.data[len("broadcast_confirm_"):].rsplit("_", 1))
     
     # Get all users
     db = next(context.bot_data['db_session_generator']())
     try:
-        from database import User
-        users = db.query(User).all()
-        total_users = len(users)
-        
-        # Send message to each user
-        success = 0
-        failed = 0
+        chat_ids = [telegram_id for telegram_id, in db.query(User.telegram_id)]
+        total_users = len(chat_ids)
         
         await query.message.edit_text(f"🔄 در حال ارسال پیام به {total_users} کاربر...")
         
-        for user in users:
+        # A fixed pool of workers drains the ids, so pending sends don't grow with the user table
+        pending = iter(chat_ids)
+        progress = {'done': 0, 'failed': 0}
+        workers = asyncio.gather(
+            *(_broadcast_worker(context.bot, pending, from_chat_id, message_id, progress)
+              for _ in range(min(BROADCAST_RATE_LIMIT, total_users)))
+        )
+        
+        # Keep the admin posted while the workers run
+        while True:
+            done, _ = await asyncio.wait({workers}, timeout=BROADCAST_PROGRESS_INTERVAL)
+            if done:
+                break
             try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=message_text,
-                    parse_mode=ParseMode.MARKDOWN
+                await query.message.edit_text(
+                    f"🔄 در حال ارسال پیام به {total_users} کاربر... ({progress['done']}/{total_users})"
                 )
-                success += 1
-                await asyncio.sleep(0.05)  # Rate limiting
             except Exception as e:
-                logger.error(f"Error sending broadcast to user {user.id}: {e}")
-                failed += 1
-                
+                logger.warning(f"Failed to update broadcast progress: {e}")
+        await workers
+        
+        failed = progress['failed']
+        success = total_users - failed
+        
         # Send report
         report = (
             f"✅ ارسال پیام همگانی به پایان رسید\n\n"
@@ -477,6 +604,14 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
     finally:
         db.close()
 
+# Admin panel button actions; anything else returns to the panel
+ADMIN_BUTTON_ACTIONS = {
+    'payments': admin_payments,
+    'stats': admin_stats,
+    'users': list_users,
+    'broadcast': broadcast,
+}
+
 async def admin_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle admin button callbacks."""
     query = update.callback_query
@@ -489,16 +624,8 @@ async def admin_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         
     action = callback_data[1].split('_')[0]
     
-    if action == 'payments':
-        await admin_payments(update, context)
-    elif action == 'stats':
-        await admin_stats(update, context)
-    elif action == 'users':
-        await list_users(update, context)
-    elif action == 'broadcast':
-        await broadcast(update, context)
-    else:
-        await admin_panel(update, context)
+    handler = ADMIN_BUTTON_ACTIONS.get(action, admin_panel)
+    await handler(update, context)
 
 # Create command handlers
 admin_handler = CommandHandler("admin", admin_panel)
@@ -1,24 +1,24 @@
+import logging
+from datetime import datetime
+from functools import lru_cache
+from string import Template
+
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler
 from telegram.constants import ParseMode
 
 from database import create_payment, get_user, get_user_subscription, update_subscription_plan
-from config import PLAN_LIMITS, SubscriptionPlans, PAYMENT_CARD_NUMBER, PAYMENT_CARD_OWNER
+from config import PLAN_LIMITS, PLAN_DISPLAY_NAMES, SubscriptionPlans, PAYMENT_CARD_NUMBER, PAYMENT_CARD_OWNER
 from utils.helpers import format_price
 
+logger = logging.getLogger(__name__)
+
 # Helper function to get plan details for display
 def get_plan_display_info(plan):
-    plan_names = {
-        SubscriptionPlans.FREE: "رایگان",
-        SubscriptionPlans.BRONZE: "برنزی",
-        SubscriptionPlans.SILVER: "نقره‌ای",
-        SubscriptionPlans.GOLD: "طلایی"
-    }
-    
     plan_info = PLAN_LIMITS.get(plan, {})
     
     return {
-        "name": plan_names.get(plan, plan),
+        "name": PLAN_DISPLAY_NAMES.get(plan, plan),
         "price": plan_info.get("price", 0),
         "daily_downloads": plan_info.get("daily_downloads", 0),
         "max_file_size": plan_info.get("max_file_size", 0) / (1024 * 1024),  # Convert to MB
@@ -26,41 +26,12 @@ def get_plan_display_info(plan):
         "watermark": plan_info.get("watermark", False)
     }
 
-async def buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show available subscription plans"""
-    query = update.callback_query if hasattr(update, 'callback_query') else None
-    
-    # Get user from database
-    db = context.bot_data["db"]
-    user = get_user(db, update.effective_user.id)
-    
-    if not user:
-        print(f"User not found for telegram_id: {update.effective_user.id}")
-        print(f"All users in DB: {[u.telegram_id for u in db.query(User).all()]}")
-        error_text = "خطا در یافتن اطلاعات کاربر. لطفا دوباره امتحان کنید."
-        if query:
-            await query.answer(error_text, show_alert=True)
-        else:
-            await update.message.reply_text(error_text)
-        return
-    
-    # Get user's current subscription
-    current_subscription = get_user_subscription(db, user.id)
-    
-    # Prepare plan details
-    plans_info = []
-    for plan in [SubscriptionPlans.BRONZE, SubscriptionPlans.SILVER, SubscriptionPlans.GOLD]:
-        plan_info = get_plan_display_info(plan)
-        plans_info.append(plan_info)
-    
+def _build_plans_text(plans_info):
+    """Render the plan list; it only depends on config so it is built once at import"""
     # Prepare message text
     text = "🎟️ *پلن‌های اشتراک*\n\n"
     
-    for plan_info in plans_info:
-        # Skip if no price (shouldn't happen for paid plans)
-        if not plan_info["price"]:
-            continue
-            
+    for _, plan_info in plans_info:
         text += f"🔸 *{plan_info['name']}* - {format_price(plan_info['price'])} تومان\n"
         
         # Add plan features
@@ -92,26 +63,26 @@ async def buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"👤 صاحب حساب: {PAYMENT_CARD_OWNER}\n"
     text += "📞 پشتیبانی: @your_support_username"
     
+    return text
+
+# Paid plans in display order; the free plan is never offered for purchase
+PAID_PLANS_INFO = [
+    (plan, get_plan_display_info(plan))
+    for plan in [SubscriptionPlans.BRONZE, SubscriptionPlans.SILVER, SubscriptionPlans.GOLD]
+    if PLAN_LIMITS.get(plan, {}).get("price")
+]
+PLANS_TEXT = _build_plans_text(PAID_PLANS_INFO)
+
+@lru_cache(maxsize=None)
+def plans_keyboard(current_plan):
+    """Plan selection keyboard; markups are immutable, so one per current plan is shared"""
     # Create inline keyboard for plan selection
     keyboard = []
-    for plan_info in plans_info:
-        if not plan_info["price"]:  # Skip free plan
-            continue
-            
+    for plan_enum, plan_info in PAID_PLANS_INFO:
         plan_name = plan_info["name"]
-        plan_enum = {
-            "برنزی": SubscriptionPlans.BRONZE,
-            "نقره‌ای": SubscriptionPlans.SILVER,
-            "طلایی": SubscriptionPlans.GOLD
-        }.get(plan_name)
         
         # Check if user already has this plan
-        is_current_plan = (
-            current_subscription and 
-            current_subscription.plan == plan_enum and 
-            current_subscription.is_active and
-            (not current_subscription.end_date or current_subscription.end_date > datetime.utcnow())
-        )
+        is_current_plan = plan_enum == current_plan
         
         button_text = f"✅ {plan_name}" if is_current_plan else plan_name
         
@@ -127,23 +98,64 @@ async def buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         InlineKeyboardButton("🔙 بازگشت", callback_data="start")
     ])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+async def buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show available subscription plans"""
+    query = update.callback_query if hasattr(update, 'callback_query') else None
+    
+    # Get user from database
+    db = context.bot_data["db"]
+    user = get_user(db, update.effective_user.id)
+    
+    if not user:
+        logger.warning(f"User not found for telegram_id: {update.effective_user.id}")
+        error_text = "خطا در یافتن اطلاعات کاربر. لطفا دوباره امتحان کنید."
+        if query:
+            await query.answer(error_text, show_alert=True)
+        else:
+            await update.message.reply_text(error_text)
+        return
+    
+    # Get user's current subscription
+    current_subscription = get_user_subscription(db, user.id)
+    
+    # Resolve the user's active plan once rather than per button
+    current_plan = None
+    if (current_subscription and
+            current_subscription.is_active and
+            (not current_subscription.end_date or current_subscription.end_date > datetime.utcnow())):
+        current_plan = current_subscription.plan
+    
+    reply_markup = plans_keyboard(current_plan)
     
     # Send or update message
     if query:
         await query.message.edit_text(
-            text,
+            PLANS_TEXT,
             reply_markup=reply_markup,
             parse_mode=ParseMode.MARKDOWN
         )
         await query.answer()
     else:
         await update.message.reply_text(
-            text,
+            PLANS_TEXT,
             reply_markup=reply_markup,
             parse_mode=ParseMode.MARKDOWN
         )
 
+# Payment instructions sent after a plan is selected
+PAYMENT_TEXT_TEMPLATE = Template(
+    "💳 *پرداخت اشتراک ${plan_name}*\n\n"
+    "مبلغ قابل پرداخت: *${price} تومان*\n\n"
+    "لطفا مبلغ فوق را به شماره کارت زیر واریز کنید:\n"
+    "`${card_number}`\n\n"
+    "👤 صاحب حساب: ${card_owner}\n\n"
+    "پس از واریز، رسید پرداخت را برای پشتیبانی ارسال کنید.\n"
+    "پس از تایید پرداخت، اشتراک شما فعال خواهد شد.\n\n"
+    "شناسه پرداخت: `${payment_id}`\n"
+)
+
 async def select_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle plan selection"""
     query = update.callback_query
@@ -161,9 +173,7 @@ async def select_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = get_user(db, update.effective_user.id)
         
         if not user:
-            # Add debug logging
-            print(f"User not found for telegram_id: {update.effective_user.id}")
-            print(f"All users in DB: {[u.telegram_id for u in db.query(User).all()]}")
+            logger.warning(f"User not found for telegram_id: {update.effective_user.id}")
             await query.answer("خطا در یافتن اطلاعات کاربر. لطفا دوباره امتحان کنید.", show_alert=True)
             return
         
@@ -176,14 +186,13 @@ async def select_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # Prepare payment instructions
-        text = f"💳 *پرداخت اشتراک {plan_info['name']}*\n\n"
-        text += f"مبلغ قابل پرداخت: *{format_price(plan_info['price'])} تومان*\n\n"
-        text += "لطفا مبلغ فوق را به شماره کارت زیر واریز کنید:\n"
-        text += f"`{PAYMENT_CARD_NUMBER}`\n\n"
-        text += f"👤 صاحب حساب: {PAYMENT_CARD_OWNER}\n\n"
-        text += "پس از واریز، رسید پرداخت را برای پشتیبانی ارسال کنید.\n"
-        text += "پس از تایید پرداخت، اشتراک شما فعال خواهد شد.\n\n"
-        text += f"شناسه پرداخت: `{payment.id}`\n"
+        text = PAYMENT_TEXT_TEMPLATE.substitute(
+            plan_name=plan_info['name'],
+            price=format_price(plan_info['price']),
+            card_number=PAYMENT_CARD_NUMBER,
+            card_owner=PAYMENT_CARD_OWNER,
+            payment_id=payment.id
+        )
         
         # Send the payment instructions by editing the message
         await query.edit_message_text(
@@ -191,9 +200,7 @@ async def select_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.MARKDOWN
         )
     except Exception as e:
-        print(f"Error in select_plan: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Error in select_plan: {e}", exc_info=True)
         await query.answer("خطا در پردازش درخواست. لطفا دوباره امتحان کنید.", show_alert=True)
 
 # Command handler for /buy
@@ -1,9 +1,13 @@
 import logging
 import os
+import shutil
 import tempfile
 import asyncio
+import heapq
+import re
+import time
+from operator import itemgetter
 from typing import Optional, Tuple
-from datetime import datetime
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, MessageHandler, filters, CallbackQueryHandler
@@ -11,24 +15,64 @@ from telegram.constants import ParseMode, FileSizeLimit
 
 from database import (
     get_user_subscription,
-    record_download,
-    get_user_downloads
+    get_user_downloads,
+    download_record_batcher
 )
-from config import PLAN_LIMITS, SubscriptionPlans
-from utils.helpers import format_size, get_readable_time, format_timedelta
-from utils.downloader import Downloader, DownloadError
+from config import PLAN_LIMITS, PLAN_DOWNLOAD_SLOTS, YTDLP_DOWNLOAD_WORKERS, SubscriptionPlans
+from utils.helpers import format_size, get_readable_time, format_timedelta, create_progress_bar
+from utils.downloader import DownloadError, downloader
+from utils.progress_batcher import progress_batcher
 from utils.ffmpeg import process_video
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Static keyboards, built once and shared by all messages
+BUY_PLAN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan")]
+])
+UPGRADE_PLAN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 ارتقای اشتراک", callback_data="buy_plan")]
+])
+
+# Sites we download from; a URL is supported if it mentions one of them
+SUPPORTED_DOMAINS = ('youtube.com', 'youtu.be', 'instagram.com', 'tiktok.com', 'twitter.com')
+# Scheme check and every domain in one pass instead of a substring test per domain
+SUPPORTED_URL_PATTERN = re.compile(
+    r'https?://.*?(?:' + '|'.join(map(re.escape, SUPPORTED_DOMAINS)) + ')',
+    re.DOTALL
+)
+
+# Quality labels and their order; a format takes the first label found in its resolution
+QUALITY_RANKS = {
+    '144p': 1, '240p': 2, '360p': 3, '480p': 4,
+    '720p': 5, '1080p': 6, '1440p': 7, '2160p': 8, '4k': 8
+}
+# Plan limits also use "1080p+", anything above 1080p short of 4K
+PLAN_QUALITY_RANKS = {**QUALITY_RANKS, '1080p+': 7}
+
+def _quality_rank(resolution: str) -> int:
+    """Get the rank of a lowercase resolution string, 0 if it has no known label"""
+    for label, rank in QUALITY_RANKS.items():
+        if label in resolution:
+            return rank
+    return 0
+
+# Concurrent download slots per subscription plan
+DOWNLOAD_ADMISSION = {
+    plan: asyncio.Semaphore(slots) for plan, slots in PLAN_DOWNLOAD_SLOTS.items()
+}
+# The plans' slots add up to more than the yt-dlp download pool, so this caps the
+# total at the pool size and an admitted download never waits for a worker thread
+DOWNLOAD_WORKER_SLOTS = asyncio.Semaphore(YTDLP_DOWNLOAD_WORKERS)
+
 
 class DownloadManager:
     """Manages file downloads with subscription-based restrictions"""
     
     def __init__(self, context):
         self.context = context
-        self.downloader = Downloader()
+        self.downloader = downloader
         self.active_downloads = {}
     
     async def handle_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -61,9 +105,7 @@ class DownloadManager:
         if not subscription or not subscription.is_active:
             await message.reply_text(
                 "❌ اشتراک شما فعال نیست. لطفا برای دانلود فایل، اشتراک تهیه کنید.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan")]
-                ])
+                reply_markup=BUY_PLAN_KEYBOARD
             )
             return
         
@@ -74,9 +116,7 @@ class DownloadManager:
             await message.reply_text(
                 "❌ تعداد دانلود روزانه شما به پایان رسیده است.\n"
                 "لطفا اشتراک خود را ارتقا دهید یا فردا مجددا تلاش کنید.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛒 ارتقای اشتراک", callback_data="buy_plan")]
-                ])
+                reply_markup=UPGRADE_PLAN_KEYBOARD
             )
             return
         
@@ -94,21 +134,19 @@ class DownloadManager:
                 return
             
             # Filter formats based on subscription plan
-            allowed_formats = self._filter_allowed_formats(formats, subscription.plan)
+            allowed_formats = self._filter_allowed_formats(formats, subscription.plan, limit=10)
             
             if not allowed_formats:
                 await loading_msg.edit_text(
                     "❌ هیچ فرمت مجازی برای اشتراک فعلی شما یافت نشد.\n"
                     "لطفا اشتراک خود را ارتقا دهید.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🛒 ارتقای اشتراک", callback_data="buy_plan")]
-                    ])
+                    reply_markup=UPGRADE_PLAN_KEYBOARD
                 )
                 return
             
             # Prepare format selection keyboard
             keyboard = []
-            for fmt in allowed_formats[:10]:  # Show max 10 formats
+            for fmt in allowed_formats:  # Show max 10 formats
                 quality = fmt.get('resolution', fmt.get('ext', 'N/A'))
                 size = format_size(fmt.get('filesize', 0) or fmt.get('filesize_approx', 0))
                 text = f"🎬 {quality} ({size})"
@@ -160,9 +198,7 @@ class DownloadManager:
         if not subscription or not subscription.is_active:
             await message.edit_text(
                 "❌ اشتراک شما منقضی شده است. لطفا برای دانلود فایل، اشتراک تهیه کنید.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan")]
-                ])
+                reply_markup=BUY_PLAN_KEYBOARD
             )
             return
         
@@ -185,47 +221,62 @@ class DownloadManager:
                     f"❌ حجم فایل ({format_size(file_size)}) بیشتر از حد مجاز "
                     f"({format_size(max_size)}) برای اشتراک فعلی شما است.\n\n"
                     "لطفا اشتراک خود را ارتقا دهید.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🛒 ارتقای اشتراک", callback_data="buy_plan")]
-                    ])
+                    reply_markup=UPGRADE_PLAN_KEYBOARD
                 )
                 return
             
-            # Update download status
-            status_msg = await message.edit_text("⏳ در حال آماده‌سازی دانلود...")
+            # Reject early instead of queueing unbounded work when the plan's slots
+            # or the download workers are all taken
+            admission = DOWNLOAD_ADMISSION[subscription.plan]
+            if admission.locked() or DOWNLOAD_WORKER_SLOTS.locked():
+                await message.edit_text(
+                    "⏳ سرور در حال حاضر شلوغ است. لطفا چند دقیقه دیگر دوباره تلاش کنید."
+                )
+                return
             
-            # Create temp directory
-            with tempfile.TemporaryDirectory() as temp_dir:
+            # Take the slots before any await so concurrent requests cannot slip past the check;
+            # acquire() does not suspend while a slot is free
+            await admission.acquire()
+            await DOWNLOAD_WORKER_SLOTS.acquire()
+            try:
+                # Update download status
+                status_msg = await message.edit_text("⏳ در حال آماده‌سازی دانلود...")
+
+                # Create temp directory off the event loop
+                temp_dir = await asyncio.to_thread(tempfile.mkdtemp)
+
                 # Start download
                 download_task = asyncio.create_task(
                     self._download_file(url, format_id, temp_dir, status_msg, user.id)
                 )
-                
+
                 # Store download task
                 self.active_downloads[user.id] = {
                     'task': download_task,
-                    'start_time': datetime.now(),
+                    'start_time': time.monotonic(),
                     'status_msg': status_msg,
                     'file_size': file_size
                 }
-                
+
                 try:
                     # Wait for download to complete
                     output_path = await download_task
-                    
-                    # Record download in database
+
+                    # Use the real size on disk instead of the format's estimate
+                    file_size = (await asyncio.to_thread(os.stat, output_path)).st_size
+
+                    # Record download in database (batched with other downloads)
                     file_name = os.path.basename(output_path)
-                    record_download(
-                        db=db,
+                    download_record_batcher.submit(
                         user_id=user.id,
                         file_url=url,
                         file_name=file_name,
                         file_size=file_size
                     )
-                    
+
                     # Send file to user
-                    await self._send_file(user.id, output_path, status_msg)
-                    
+                    await self._send_file(context.bot, user.id, output_path, file_size, status_msg)
+
                 except asyncio.CancelledError:
                     await status_msg.edit_text("❌ دانلود لغو شد.")
                 except Exception as e:
@@ -237,13 +288,13 @@ class DownloadManager:
                     # Clean up
                     if user.id in self.active_downloads:
                         del self.active_downloads[user.id]
-                    
-                    # Delete temp file if it exists
-                    if os.path.exists(output_path):
-                        try:
-                            os.remove(output_path)
-                        except:
-                            pass
+
+                    # Remove the file and any partial downloads without blocking the loop
+                    await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+            finally:
+                # Free the slots once the file is sent or the attempt ends
+                DOWNLOAD_WORKER_SLOTS.release()
+                admission.release()
         
         except Exception as e:
             logger.error(f"Error in download process: {str(e)}", exc_info=True)
@@ -256,6 +307,9 @@ class DownloadManager:
         """Download file with progress updates"""
         output_template = os.path.join(temp_dir, "%(title)s.%(ext)s")
         
+        # Progress edits are coalesced and flushed by the shared batcher
+        progress_batcher.start()
+        
         # Start download
         download_task = asyncio.create_task(
             self.downloader.download(
@@ -267,10 +321,24 @@ class DownloadManager:
         )
         
         try:
-            return await download_task
+            output_path = await download_task
         except Exception as e:
             logger.error(f"Download failed: {str(e)}")
             raise
+        finally:
+            # Don't let a stale progress edit overwrite the final status
+            progress_batcher.discard(status_msg)
+        
+        # Sent directly so it replaces the last progress edit for the whole upload
+        try:
+            await status_msg.edit_text(
+                "✅ دانلود با موفقیت انجام شد.\n\n"
+                "در حال پردازش فایل..."
+            )
+        except Exception as e:
+            logger.warning(f"Failed to update download status: {str(e)}")
+        
+        return output_path
     
     def _progress_hook(self, d: dict, status_msg, user_id: int):
         """Update download progress"""
@@ -280,8 +348,15 @@ class DownloadManager:
         download_info = self.active_downloads[user_id]
         
         if d['status'] == 'downloading':
+            # yt-dlp calls this many times a second; skip all formatting
+            # unless an update is due (every 3 seconds)
+            current_time = time.monotonic()
+            last_update = download_info.get('last_update_time')
+            if last_update and current_time - last_update <= 3:
+                return
+            
             # Calculate download speed
-            elapsed = (datetime.now() - download_info['start_time']).total_seconds()
+            elapsed = current_time - download_info['start_time']
             if elapsed > 0:
                 speed = d.get('downloaded_bytes', 0) / elapsed
                 speed_str = f"{format_size(speed)}/s"
@@ -292,9 +367,7 @@ class DownloadManager:
             total_size = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
             if total_size > 0:
                 percent = d['downloaded_bytes'] / total_size * 100
-                progress = int(percent / 5)  # 20 steps (5% each)
-                progress_bar = "▓" * progress + "░" * (20 - progress)
-                progress_text = f"{progress_bar} {percent:.1f}%"
+                progress_text = f"{create_progress_bar(percent)} {percent:.1f}%"
             else:
                 progress_text = "در حال دریافت اطلاعات..."
             
@@ -314,28 +387,16 @@ class DownloadManager:
                 f"⏳ زمان باقی‌مانده: {eta_str}"
             )
             
-            # Only update if status has changed significantly
-            current_time = datetime.now()
-            last_update = download_info.get('last_update_time')
-            
-            if not last_update or (current_time - last_update).total_seconds() > 3:  # Update every 3 seconds
-                asyncio.create_task(status_msg.edit_text(
-                    status_text,
-                    parse_mode=ParseMode.MARKDOWN
-                ))
-                download_info['last_update_time'] = current_time
-        
-        elif d['status'] == 'finished':
-            asyncio.create_task(status_msg.edit_text(
-                "✅ دانلود با موفقیت انجام شد.\n\n"
-                "در حال پردازش فایل..."
-            ))
+            progress_batcher.submit(
+                status_msg,
+                status_text,
+                parse_mode=ParseMode.MARKDOWN
+            )
+            download_info['last_update_time'] = current_time
     
-    async def _send_file(self, chat_id: int, file_path: str, status_msg):
-        """Send downloaded file to user"""
+    async def _send_file(self, bot, chat_id: int, file_path: str, file_size: int, status_msg):
+        """Send downloaded file to user through the application's shared bot"""
         try:
-            file_size = os.path.getsize(file_path)
-            
             # Check if file is too large for Telegram
             if file_size > FileSizeLimit.FILESIZE_DOWNLOAD:
                 await status_msg.edit_text(
@@ -344,9 +405,11 @@ class DownloadManager:
                 )
                 return
             
-            # Send file
-            with open(file_path, 'rb') as f:
-                await self.context.bot.send_document(
+            # Open off the event loop and always release the descriptor,
+            # so a failed upload doesn't leak it
+            f = await asyncio.to_thread(open, file_path, 'rb')
+            try:
+                await bot.send_document(
                     chat_id=chat_id,
                     document=f,
                     filename=os.path.basename(file_path),
@@ -354,6 +417,8 @@ class DownloadManager:
                             f"📦 حجم فایل: {format_size(file_size)}",
                     parse_mode=ParseMode.MARKDOWN
                 )
+            finally:
+                f.close()
             
             await status_msg.delete()
             
@@ -366,57 +431,34 @@ class DownloadManager:
     def _is_valid_url(self, url: str) -> bool:
         """Check if URL is valid for download"""
         # Simple URL validation
-        return (url.startswith(('http://', 'https://')) and 
-                any(domain in url for domain in ['youtube.com', 'youtu.be', 'instagram.com', 'tiktok.com', 'twitter.com']))
+        return SUPPORTED_URL_PATTERN.match(url) is not None
     
-    def _filter_allowed_formats(self, formats: list, plan: str) -> list:
-        """Filter available formats based on subscription plan"""
-        plan_limits = PLAN_LIMITS.get(plan, {})
-        max_quality = plan_limits.get('max_quality', '720p')
-        
-        # Map quality strings to numeric values for comparison
-        quality_map = {
-            '144p': 1, '240p': 2, '360p': 3, '480p': 4,
-            '720p': 5, '1080p': 6, '1440p': 7, '2160p': 8, '4K': 8
-        }
-        
-        max_quality_num = quality_map.get(max_quality, 3)  # Default to 360p
+    def _filter_allowed_formats(self, formats: list, plan: str, limit: Optional[int] = None) -> list:
+        """Filter available formats based on subscription plan, best quality first"""
+        max_quality = PLAN_LIMITS.get(plan, {}).get('max_quality', '720p')
+        max_rank = PLAN_QUALITY_RANKS.get(max_quality.lower(), 3)  # Default to 360p
         
-        allowed_formats = []
+        # Rank each format once, pairing it with its sort key
+        ranked = []
         for fmt in formats:
-            # Skip audio-only formats
-            if fmt.get('vcodec') == 'none':
+            # Skip audio-only formats and formats without a resolution
+            resolution = (fmt.get('resolution') or '').lower()
+            if fmt.get('vcodec') == 'none' or not resolution:
                 continue
-                
-            # Check resolution
-            resolution = fmt.get('resolution', '').lower()
-            if not resolution:
-                continue
-                
-            # Extract quality number (e.g., '720p' -> 720)
-            quality_num = 0
-            for q, num in quality_map.items():
-                if q in resolution:
-                    quality_num = num
-                    break
             
             # Skip if quality exceeds plan limit
-            if quality_num > max_quality_num:
-                continue
-            
-            # Add format to allowed list
-            allowed_formats.append(fmt)
-        
-        # Sort by quality (descending) and file size (descending)
-        allowed_formats.sort(
-            key=lambda x: (
-                quality_map.get(x.get('resolution', '0p').lower().split('p')[0] + 'p', 0),
-                x.get('filesize', 0) or x.get('filesize_approx', 0)
-            ),
-            reverse=True
-        )
+            rank = _quality_rank(resolution)
+            if rank <= max_rank:
+                size = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+                ranked.append(((rank, size), fmt))
         
-        return allowed_formats
+        # Best quality, then largest file; only the shown formats need ordering
+        key = itemgetter(0)
+        if limit:
+            best = heapq.nlargest(limit, ranked, key=key)
+        else:
+            best = sorted(ranked, key=key, reverse=True)
+        return [fmt for _, fmt in best]
 
 # Create global download manager instance
 download_manager = DownloadManager(None)
@@ -3,21 +3,25 @@ from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler
 from telegram.constants import ParseMode
 
 from database import get_user_subscription
-from config import PLAN_LIMITS, SubscriptionPlans
+from config import PLAN_LIMITS, PLAN_DISPLAY_NAMES, SubscriptionPlans
+
+# Quick actions keyboard for the help message (static, built once)
+HELP_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan"),
+        InlineKeyboardButton("📊 وضعیت اشتراک", callback_data="subscription_status")
+    ],
+    [
+        InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="start")
+    ]
+])
 
 # Helper function to get plan details
 def get_plan_details(plan):
-    plan_names = {
-        SubscriptionPlans.FREE: "رایگان",
-        SubscriptionPlans.BRONZE: "برنزی",
-        SubscriptionPlans.SILVER: "نقره‌ای",
-        SubscriptionPlans.GOLD: "طلایی"
-    }
-    
     plan_info = PLAN_LIMITS.get(plan, {})
     
     details = []
-    details.append(f"📌 *{plan_names.get(plan, plan)}*")
+    details.append(f"📌 *{PLAN_DISPLAY_NAMES.get(plan, plan)}*")
     
     # Add price if not free
     if plan != SubscriptionPlans.FREE:
@@ -80,18 +84,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📞 پشتیبانی: @your_support_username"""
     
-    # Create inline keyboard for quick actions
-    keyboard = [
-        [
-            InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan"),
-            InlineKeyboardButton("📊 وضعیت اشتراک", callback_data="subscription_status")
-        ],
-        [
-            InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="start")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = HELP_KEYBOARD
     
     # Send message
     if update.callback_query:
@@ -1,21 +1,49 @@
+from string import Template
+
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CommandHandler
 from telegram.constants import ParseMode
 
 from database import get_or_create_user, get_user_subscription
-from config import PLAN_LIMITS, SubscriptionPlans
+from config import PLAN_LIMITS, PLAN_DISPLAY_NAMES
+
+# Message templates, parsed once at import
+SUBSCRIPTION_INFO_TEMPLATE = Template("""✅ *وضعیت اشتراک:* فعال
+
+📋 *پلن:* ${plan_name}
+📥 *دانلود باقی‌مانده امروز:* ${remaining_downloads}
+📆 *تاریخ انقضا:* ${end_date}
+
+برای مشاهده امکانات ربات از منوی پایین استفاده کنید.""")
+
+WELCOME_TEMPLATE = Template("""سلام ${first_name} 👋
+
+به ربات دانلودر خوش آمدید! با استفاده از این ربات می‌توانید فایل‌های ویدیویی را با کیفیت بالا دانلود کنید.
+
+${subscription_info}""")
+
+# Main menu keyboards, built once; admins get an extra panel row
+_MAIN_MENU_ROWS = [
+    [
+        InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan"),
+        InlineKeyboardButton("📥 دانلود فایل", callback_data="download")
+    ],
+    [
+        InlineKeyboardButton("📊 وضعیت اشتراک", callback_data="subscription_status"),
+        InlineKeyboardButton("ℹ️ راهنما", callback_data="help")
+    ]
+]
+START_KEYBOARD = InlineKeyboardMarkup(_MAIN_MENU_ROWS)
+START_ADMIN_KEYBOARD = InlineKeyboardMarkup(
+    _MAIN_MENU_ROWS + [[InlineKeyboardButton("👑 پنل مدیریت", callback_data="admin")]]
+)
 
 # Helper function to get subscription info text
 def get_subscription_info(subscription):
     if not subscription or not subscription.is_active:
         return "❌ *وضعیت اشتراک:* غیرفعال\n\nشما اشتراک فعالی ندارید. لطفا برای استفاده از امکانات ربات، اشتراک تهیه کنید."
     
-    plan_name = {
-        SubscriptionPlans.FREE: "رایگان",
-        SubscriptionPlans.BRONZE: "برنزی",
-        SubscriptionPlans.SILVER: "نقره‌ای",
-        SubscriptionPlans.GOLD: "طلایی"
-    }.get(subscription.plan, "ناشناخته")
+    plan_name = PLAN_DISPLAY_NAMES.get(subscription.plan, "ناشناخته")
     
     plan_limits = PLAN_LIMITS.get(subscription.plan, {})
     
@@ -30,13 +58,11 @@ def get_subscription_info(subscription):
     if subscription.end_date:
         end_date = subscription.end_date.strftime("%Y-%m-%d %H:%M")
     
-    return f"""✅ *وضعیت اشتراک:* فعال
-
-📋 *پلن:* {plan_name}
-📥 *دانلود باقی‌مانده امروز:* {remaining_downloads}
-📆 *تاریخ انقضا:* {end_date}
-
-برای مشاهده امکانات ربات از منوی پایین استفاده کنید."""
+    return SUBSCRIPTION_INFO_TEMPLATE.substitute(
+        plan_name=plan_name,
+        remaining_downloads=remaining_downloads,
+        end_date=end_date
+    )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
@@ -56,33 +82,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     subscription = get_user_subscription(db, db_user.id)
     
     # Prepare welcome message
-    welcome_text = f"""سلام {user.first_name} 👋
-
-به ربات دانلودر خوش آمدید! با استفاده از این ربات می‌توانید فایل‌های ویدیویی را با کیفیت بالا دانلود کنید.
-
-{subscription_info}"""
-    
-    # Get subscription info
-    subscription_info = get_subscription_info(subscription)
-    welcome_text = welcome_text.format(subscription_info=subscription_info)
-    
-    # Create inline keyboard for main menu
-    keyboard = [
-        [
-            InlineKeyboardButton("🛒 خرید اشتراک", callback_data="buy_plan"),
-            InlineKeyboardButton("📥 دانلود فایل", callback_data="download")
-        ],
-        [
-            InlineKeyboardButton("📊 وضعیت اشتراک", callback_data="subscription_status"),
-            InlineKeyboardButton("ℹ️ راهنما", callback_data="help")
-        ]
-    ]
+    welcome_text = WELCOME_TEMPLATE.substitute(
+        first_name=user.first_name,
+        subscription_info=get_subscription_info(subscription)
+    )
     
     # Add admin button if user is admin
     if user.id in context.bot_data["admin_ids"]:
-        keyboard.append([InlineKeyboardButton("👑 پنل مدیریت", callback_data="admin")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = START_ADMIN_KEYBOARD
+    else:
+        reply_markup = START_KEYBOARD
     
     # Send welcome message
     await update.message.reply_text(
@@ -1,6 +1,7 @@
 """
 Beast Downloader Bot - Main Entry Point
 """
+import asyncio
 import logging
 import os
 import sys
@@ -18,8 +19,6 @@ from telegram.ext import (
     ApplicationBuilder,
 )
 from telegram.error import TelegramError
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
 
 # Add parent directory to path to allow importing modules
 sys.path.append(str(Path(__file__).parent.parent))
@@ -33,10 +32,10 @@ from bot.handlers import (
     download as download_handlers_module,
 )
 from bot.middleware import setup_middlewares
-from database import Base
+from database import Base, engine, SessionLocal, get_db, download_record_batcher
+from utils.downloader import downloader
 from config import (
     BOT_TOKEN,
-    DATABASE_URL,
     ADMIN_IDS,
     LOG_LEVEL,
     WEBHOOK_MODE,
@@ -60,9 +59,10 @@ logger = logging.getLogger(__name__)
 class DatabaseManager:
     """Manages database connections and sessions."""
     
-    def __init__(self, database_url: str):
-        self.engine = create_engine(database_url)
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+    def __init__(self):
+        # Reuse the pooled engine from database.models instead of opening a second pool
+        self.engine = engine
+        self.SessionLocal = SessionLocal
         
         # Create database tables
         Base.metadata.create_all(bind=self.engine)
@@ -78,7 +78,7 @@ class DatabaseManager:
             raise
 
 # Initialize database manager
-db_manager = DatabaseManager(DATABASE_URL)
+db_manager = DatabaseManager()
 
 # Disable some noisy logs
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -150,13 +150,22 @@ async def post_init(application: Application) -> None:
     """Configure bot commands and other post-initialization tasks."""
     # Store database manager in bot_data for use in handlers
     application.bot_data['db_manager'] = db_manager
+    # Handlers and middleware open per-update sessions through this generator
+    application.bot_data['db_session_generator'] = get_db
+    
+    # Refresh admin statistics in the background instead of on every /stats
+    application.bot_data['stats_refresher'] = asyncio.create_task(
+        admin_handler.refresh_stats_loop(db_manager.get_db)
+    )
     
     # Set bot commands for regular users
-    await application.bot.set_my_commands([
-        BotCommand("start", "شروع کار با ربات"),
-        BotCommand("help", "راهنمای استفاده"),
-        BotCommand("buy", "خرید اشتراک"),
-    ])
+    requests = [
+        application.bot.set_my_commands([
+            BotCommand("start", "شروع کار با ربات"),
+            BotCommand("help", "راهنمای استفاده"),
+            BotCommand("buy", "خرید اشتراک"),
+        ])
+    ]
     
     # Set admin commands for admin users
     if ADMIN_IDS:
@@ -169,13 +178,32 @@ async def post_init(application: Application) -> None:
         
         # Add admin commands for both private chats and groups
         for scope_type in ["all_private_chats", "all_group_chats"]:
-            await application.bot.set_my_commands(
+            requests.append(application.bot.set_my_commands(
                 [BotCommand(cmd, desc) for cmd, desc in admin_commands],
                 scope={"type": scope_type, "user_ids": ADMIN_IDS}
-            )
+            ))
+    
+    # Send all command updates at once; a slow or failing call must not block startup
+    results = await asyncio.gather(
+        *(asyncio.wait_for(request, timeout=10) for request in requests),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to set bot commands: {result!r}")
     
     logger.info("Bot is ready to receive updates")
 
+async def post_shutdown(application: Application) -> None:
+    """Stop background work started in post_init."""
+    application.bot_data['stats_refresher'].cancel()
+    
+    # Write download records still waiting for the next batch
+    await download_record_batcher.close()
+    
+    # Joining the yt-dlp threads blocks, so keep it off the event loop
+    await asyncio.to_thread(downloader.close)
+
 def main() -> None:
     """Start the bot."""
     # Create the Application with persistence and context settings
@@ -183,6 +211,7 @@ def main() -> None:
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .concurrent_updates(True)  # Enable handling updates in parallel
         .build()
     )
@@ -4,6 +4,7 @@ Middleware for enforcing subscription plan limits and features.
 from typing import Callable, Awaitable, Dict, Any, Optional
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
+from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 import logging
 
@@ -16,6 +17,34 @@ from config import PLAN_LIMITS
 
 logger = logging.getLogger(__name__)
 
+# Commands that never need a subscription; they skip the middleware stack entirely
+EXEMPT_COMMANDS = frozenset({'/start', '/help', '/buy'})
+
+def _is_exempt_command(update: Update) -> bool:
+    """Check if the update is a command that bypasses subscription checks."""
+    if update.message and update.message.text and update.message.text.startswith('/'):
+        return update.message.text.split(' ')[0].lower() in EXEMPT_COMMANDS
+    return False
+
+def _update_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
+    """Per-update state shared by the middleware stack through user_data.
+    
+    Keyed by the update id so a later update never sees stale values. Holds a
+    single `now` so every check in the stack judges expiry at the same instant.
+    """
+    state = context.user_data.get('_middleware_state')
+    if not state or state['update_id'] != update.update_id:
+        state = {'update_id': update.update_id, 'now': datetime.utcnow()}
+        context.user_data['_middleware_state'] = state
+    return state
+
+def _get_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, db, user_id: int):
+    """Get the user's subscription, querying at most once per update."""
+    state = _update_state(update, context)
+    if 'subscription' not in state:
+        state['subscription'] = get_user_subscription(db, user_id)
+    return state['subscription']
+
 class SubscriptionMiddleware:
     """Middleware to enforce subscription plan limits."""
     
@@ -24,10 +53,8 @@ class SubscriptionMiddleware:
 
     async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         # Skip middleware for commands that don't require subscription checks
-        if update.message and update.message.text and update.message.text.startswith('/'):
-            command = update.message.text.split(' ')[0].lower()
-            if command in ['/start', '/help', 'buy']:
-                return await self.handler(update, context)
+        if _is_exempt_command(update):
+            return await self.handler(update, context)
         
         # Get user ID
         user_id = update.effective_user.id if update.effective_user else None
@@ -40,7 +67,7 @@ class SubscriptionMiddleware:
         # Get user's subscription
         db = next(context.bot_data['db_session_generator']())
         try:
-            subscription = get_user_subscription(db, user_id)
+            subscription = _get_subscription(update, context, db, user_id)
             
             if not subscription or not subscription.is_active:
                 return await update.message.reply_text(
@@ -48,9 +75,10 @@ class SubscriptionMiddleware:
                 )
             
             # Check if subscription has expired
-            if subscription.end_date and subscription.end_date < datetime.utcnow():
+            if subscription.end_date and subscription.end_date < _update_state(update, context)['now']:
                 subscription.is_active = False
-                db.commit()
+                # The subscription may have been loaded by an outer middleware's session
+                Session.object_session(subscription).commit()
                 return await update.message.reply_text(
                     "❌ اشتراک شما به پایان رسیده است. لطفا اشتراک جدید خریداری کنید."
                 )
@@ -85,14 +113,14 @@ class DownloadLimitMiddleware:
         
         try:
             # Get user's subscription
-            subscription = get_user_subscription(db, user_id)
+            subscription = _get_subscription(update, context, db, user_id)
             if not subscription:
                 return await update.message.reply_text(
                     "❌ اشتراک فعالی ندارید. لطفا با استفاده از دستور /buy اشتراک تهیه کنید."
                 )
             
             # Check if user can download
-            can_download, reason = self._can_download(subscription)
+            can_download, reason = self._can_download(subscription, _update_state(update, context)['now'])
             if not can_download:
                 return await update.message.reply_text(f"❌ {reason}")
             
@@ -107,12 +135,11 @@ class DownloadLimitMiddleware:
         finally:
             db.close()
     
-    def _can_download(self, subscription) -> tuple[bool, Optional[str]]:
+    def _can_download(self, subscription, now: datetime) -> tuple[bool, Optional[str]]:
         """Check if user can download based on their subscription."""
         plan_limits = PLAN_LIMITS.get(subscription.plan, {})
         
         # Reset daily downloads if needed
-        now = datetime.utcnow()
         if subscription.last_download_reset.date() < now.date():
             subscription.daily_downloads_used = 0
             subscription.last_download_reset = now
@@ -139,6 +166,10 @@ def setup_middlewares(application):
             
             # Create middleware chain
             async def middleware_chain(update, context, handler=original_callback):
+                # Exempt commands go straight to the handler without any database work
+                if _is_exempt_command(update):
+                    return await handler(update, context)
+                
                 # Create inner function for middleware composition
                 async def inner(update, context):
                     return await handler(update, context)
@@ -9,6 +9,8 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
 
 # Redis configuration (for rate limiting and caching)
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
@@ -38,6 +40,14 @@ class SubscriptionPlans(str, Enum):
     def __str__(self):
         return self.value
 
+# Persian display names for each plan
+PLAN_DISPLAY_NAMES = {
+    SubscriptionPlans.FREE: "رایگان",
+    SubscriptionPlans.BRONZE: "برنزی",
+    SubscriptionPlans.SILVER: "نقره‌ای",
+    SubscriptionPlans.GOLD: "طلایی",
+}
+
 # Plan limits
 PLAN_LIMITS = {
     SubscriptionPlans.FREE: {
@@ -70,6 +80,38 @@ PLAN_LIMITS = {
     },
 }
 
+# Downloads that may run at once per plan, shared by all users on the plan;
+# YTDLP_DOWNLOAD_WORKERS caps the total across plans
+PLAN_DOWNLOAD_SLOTS = {
+    SubscriptionPlans.FREE: int(os.getenv("FREE_DOWNLOAD_SLOTS", 5)),
+    SubscriptionPlans.BRONZE: int(os.getenv("BRONZE_DOWNLOAD_SLOTS", 10)),
+    SubscriptionPlans.SILVER: int(os.getenv("SILVER_DOWNLOAD_SLOTS", 20)),
+    SubscriptionPlans.GOLD: int(os.getenv("GOLD_DOWNLOAD_SLOTS", 50)),
+}
+
+# Seconds the rendered /stats text is reused before querying the database again
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 10))
+
+# Seconds between background refreshes of the /stats snapshot
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", 30))
+
+# Hardware video encoding: "auto" uses the first GPU encoder that works,
+# "cuda", "vaapi" or "qsv" forces one, "none" always uses libx264
+FFMPEG_HWACCEL = os.getenv("FFMPEG_HWACCEL", "auto").lower()
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# Concurrent GPU encodes; consumer NVIDIA cards refuse sessions beyond a small limit
+FFMPEG_GPU_SESSIONS = int(os.getenv("FFMPEG_GPU_SESSIONS", 3))
+
+# yt-dlp worker threads; metadata lookups get their own pool so they never
+# queue behind long-running downloads
+YTDLP_EXTRACT_WORKERS = int(os.getenv("YTDLP_EXTRACT_WORKERS", 8))
+YTDLP_DOWNLOAD_WORKERS = int(os.getenv("YTDLP_DOWNLOAD_WORKERS", 32))
+
+# Format lists from yt-dlp are reused for this many seconds, for up to this many URLs
+FORMATS_CACHE_TTL = float(os.getenv("FORMATS_CACHE_TTL", 600))
+FORMATS_CACHE_SIZE = int(os.getenv("FORMATS_CACHE_SIZE", 512))
+
 # Payment configuration
 PAYMENT_CARD_NUMBER = os.getenv("PAYMENT_CARD_NUMBER", "")
 PAYMENT_CARD_OWNER = os.getenv("PAYMENT_CARD_OWNER", "")
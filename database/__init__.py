@@ -26,6 +26,7 @@ from .crud import (
     get_user_subscription,
     update_subscription_plan,
     record_download,
+    record_downloads,
     create_payment,
     complete_payment,
     get_user_downloads,
@@ -35,6 +36,9 @@ from .crud import (
     get_all_downloads,
 )
 
+# Import write batching
+from .write_batcher import DownloadRecordBatcher, download_record_batcher
+
 # Import schemas
 from .schemas import (
     SubscriptionPlan,
@@ -90,6 +94,7 @@ __all__ = [
     'get_user_subscription',
     'update_subscription_plan',
     'record_download',
+    'record_downloads',
     'create_payment',
     'complete_payment',
     'get_user_downloads',
@@ -98,6 +103,10 @@ __all__ = [
     'get_all_payments',
     'get_all_downloads',
     
+    # Write batching
+    'DownloadRecordBatcher',
+    'download_record_batcher',
+    
     # Enums
     'SubscriptionPlan',
     'PaymentStatusEnum',
@@ -1,3 +1,4 @@
+from collections import Counter
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_
 from datetime import datetime, timedelta
@@ -14,8 +15,8 @@ def create_user(db: Session, user_data: dict):
     """Create a new user"""
     db_user = models.User(**user_data)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    # Flush to get the user id; the user and subscription commit together
+    db.flush()
     
     # Create free subscription for new user
     subscription = models.Subscription(
@@ -42,8 +43,8 @@ def get_or_create_user(db: Session, user_data: dict):
         if update_data:
             for key, value in update_data.items():
                 setattr(db_user, key, value)
+            # Only the changed columns are written; attributes reload lazily after commit
             db.commit()
-            db.refresh(db_user)
         
         return db_user
     return create_user(db, user_data)
@@ -99,8 +100,8 @@ def record_download(db: Session, user_id: int, file_url: str, file_name: str, fi
     if not subscription:
         raise ValueError("User does not have an active subscription")
     
-    # Update download count
-    subscription.daily_downloads_used += 1
+    # Update download count in SQL so concurrent downloads can't lose an increment
+    subscription.daily_downloads_used = models.Subscription.daily_downloads_used + 1
     
     # Create download record
     download = models.Download(
@@ -117,6 +118,42 @@ def record_download(db: Session, user_id: int, file_url: str, file_name: str, fi
     
     return download
 
+def record_downloads(db: Session, records: List[dict]) -> List[models.Download]:
+    """Record several downloads in a single transaction.
+
+    Each record holds the `user_id`, `file_url`, `file_name` and `file_size`
+    of one download, as passed to `record_download`. Like `record_download`,
+    raises ValueError without writing anything if any of the users has no
+    active subscription.
+    """
+    user_ids = {record['user_id'] for record in records}
+    subscriptions = {
+        subscription.user_id: subscription
+        for subscription in db.query(models.Subscription).filter(
+            models.Subscription.user_id.in_(user_ids),
+            models.Subscription.is_active == True,
+            or_(
+                models.Subscription.end_date.is_(None),
+                models.Subscription.end_date > datetime.utcnow()
+            )
+        )
+    }
+    
+    missing = user_ids - subscriptions.keys()
+    if missing:
+        raise ValueError(f"Users {sorted(missing)} do not have an active subscription")
+    
+    # Bump each counter once by the user's total, as an in-database increment
+    for user_id, count in Counter(record['user_id'] for record in records).items():
+        subscriptions[user_id].daily_downloads_used = models.Subscription.daily_downloads_used + count
+    
+    downloads = [models.Download(**record, status="completed") for record in records]
+    
+    db.add_all(downloads)
+    db.commit()
+    
+    return downloads
+
 def create_payment(db: Session, user_id: int, amount: int, plan: SubscriptionPlans) -> models.Payment:
     """Create a new payment record"""
     payment = models.Payment(
@@ -133,14 +170,24 @@ def create_payment(db: Session, user_id: int, amount: int, plan: SubscriptionPla
     return payment
 
 def complete_payment(db: Session, payment_id: int, transaction_id: str) -> models.Payment:
-    """Mark a payment as completed"""
-    payment = db.query(models.Payment).filter(models.Payment.id == payment_id).first()
-    if not payment:
+    """Mark a pending payment as completed
+    
+    The status check and the update are a single statement, so confirming the
+    same payment twice only activates the subscription once. Returns None if
+    there is no pending payment with this id.
+    """
+    updated = db.query(models.Payment).filter(
+        models.Payment.id == payment_id,
+        models.Payment.status == models.PaymentStatus.PENDING
+    ).update({
+        models.Payment.status: models.PaymentStatus.COMPLETED,
+        models.Payment.transaction_id: transaction_id,
+        models.Payment.payment_date: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
         return None
     
-    payment.status = models.PaymentStatus.COMPLETED
-    payment.transaction_id = transaction_id
-    payment.payment_date = datetime.utcnow()
+    payment = db.get(models.Payment, payment_id, populate_existing=True)
     
     # Update user's subscription
     update_subscription_plan(db, payment.user_id, payment.plan)
@@ -15,10 +15,18 @@ from datetime import datetime, timedelta
 import enum
 from typing import Optional
 
-from config import DATABASE_URL, SubscriptionPlans
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, PLAN_LIMITS, SubscriptionPlans
 
-# Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+# Create SQLAlchemy engine; this is the only engine, shared by the whole bot
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True
+    )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -75,8 +83,6 @@ class Subscription(Base):
     
     def can_download(self, file_size: int) -> tuple[bool, Optional[str]]:
         """Check if user can download a file with given size"""
-        from config import PLAN_LIMITS
-        
         if not self.is_active:
             return False, "اشتراک شما منقضی شده است. لطفا اشتراک جدید خریداری کنید."
         
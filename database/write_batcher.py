@@ -0,0 +1,96 @@
+"""
+Write-behind batching for high-frequency database writes.
+"""
+import asyncio
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .crud import record_download, record_downloads
+from .models import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadRecordBatcher:
+    """Coalesces download history writes into periodic bulk commits"""
+    
+    def __init__(self, interval: float = 0.1, max_attempts: int = 3, retry_delay: float = 5.0,
+                 session_factory: Callable[[], Session] = SessionLocal):
+        """
+        Args:
+            interval: Seconds to wait before each flush, gathering records meanwhile
+            max_attempts: Flushes a record may fail in before it is dropped
+            retry_delay: Extra seconds to wait before a flush that retries failed records
+            session_factory: Opens the dedicated session each flush writes through
+        """
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.session_factory = session_factory
+        # (failed attempts so far, record)
+        self._pending: List[Tuple[int, dict]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def submit(self, user_id: int, file_url: str, file_name: str, file_size: int):
+        """Queue a download record; it is written with the next flush"""
+        self._pending.append((0, {
+            'user_id': user_id,
+            'file_url': file_url,
+            'file_name': file_name,
+            'file_size': file_size,
+        }))
+        
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        """Wait until every queued record has been written or dropped"""
+        if self._flush_task is not None:
+            await self._flush_task
+    
+    async def _flush_loop(self):
+        # Keep going while records arrive during a write or wait for a retry,
+        # so none of them sits until the next submit
+        while self._pending:
+            await asyncio.sleep(self.interval)
+            batch, self._pending = self._pending, []
+            # The commit blocks, so run it in a worker thread
+            retry = await asyncio.to_thread(self._write, batch)
+            if retry:
+                self._pending[:0] = retry
+                await asyncio.sleep(self.retry_delay)
+    
+    def _write(self, batch: List[Tuple[int, dict]]) -> List[Tuple[int, dict]]:
+        """Write a batch on a dedicated session; returns the records to retry"""
+        db = self.session_factory()
+        try:
+            try:
+                record_downloads(db, [record for _, record in batch])
+                return []
+            except Exception as e:
+                db.rollback()
+                logger.warning(f"Bulk write of {len(batch)} downloads failed, writing one by one: {e}")
+            
+            # One record must not cost the others their history and counter updates
+            retry = []
+            for attempts, record in batch:
+                try:
+                    record_download(db, **record)
+                except ValueError as e:
+                    # No active subscription; a retry can't fix that
+                    logger.error(f"Dropping download record {record}: {e}")
+                except Exception as e:
+                    db.rollback()
+                    if attempts + 1 < self.max_attempts:
+                        retry.append((attempts + 1, record))
+                    else:
+                        logger.error(f"Giving up on download record {record}: {e}", exc_info=True)
+            return retry
+        finally:
+            db.close()
+
+
+# Shared batcher for download history writes
+download_record_batcher = DownloadRecordBatcher()
@@ -0,0 +1,48 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.models import User, Download, Payment, PaymentStatus, Base
+from bot.handlers.admin import _load_basic_stats, render_stats_text
+from config import SubscriptionPlans
+
+# Set up test database
+TEST_DATABASE_URL = "sqlite:///:memory:"
+
+engine = create_engine(TEST_DATABASE_URL)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@pytest.fixture(scope="function")
+def session_factory():
+    """Create the test tables and hand out sessions bound to them."""
+    Base.metadata.create_all(bind=engine)
+    try:
+        yield TestingSessionLocal
+    finally:
+        Base.metadata.drop_all(bind=engine)
+
+def test_load_basic_stats(session_factory):
+    """Test the refresher's stats query runs against a real session and renders."""
+    db = session_factory()
+    user = User(telegram_id=12345, username="testuser", first_name="Test")
+    db.add(user)
+    db.flush()
+    db.add_all([
+        Download(user_id=user.id, file_url="https://youtube.com/watch?v=1",
+                 file_name="a.mp4", file_size=1024),
+        Download(user_id=user.id, file_url="https://youtube.com/watch?v=2",
+                 file_name="b.mp4", file_size=1024, status="failed"),
+        Payment(user_id=user.id, amount=50000, plan=SubscriptionPlans.BRONZE,
+                status=PaymentStatus.COMPLETED),
+    ])
+    db.commit()
+    db.close()
+
+    stats = _load_basic_stats(session_factory)
+
+    assert stats['total_users'] == 1
+    assert stats['total_downloads'] == 2
+    assert stats['downloads_by_status'] == {'completed': 1, 'failed': 1}
+    assert stats['total_payments'] == 1
+    assert stats['total_earnings'] == 50000
+    assert "completed" in render_stats_text(stats)
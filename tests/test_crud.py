@@ -0,0 +1,120 @@
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database.models import User, Subscription, Download, Payment, PaymentStatus, Base
+from database.crud import record_downloads, complete_payment
+from database.write_batcher import DownloadRecordBatcher
+from config import SubscriptionPlans
+
+# Set up test database
+TEST_DATABASE_URL = "sqlite:///:memory:"
+
+# One shared connection, so the batcher's worker threads see the same in-memory database
+engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@pytest.fixture(scope="function")
+def db_session():
+    """Create a new database session with a test database."""
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+        Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def user(db_session):
+    """Create a test user."""
+    user = User(telegram_id=12345, username="testuser", first_name="Test")
+    db_session.add(user)
+    db_session.commit()
+    return user
+
+def test_record_downloads_single_transaction(db_session, user):
+    """Test bulk recording inserts every download and bumps the daily counter."""
+    db_session.add(Subscription(user_id=user.id, plan=SubscriptionPlans.FREE, is_active=True))
+    db_session.commit()
+
+    records = [
+        {'user_id': user.id, 'file_url': f"https://youtube.com/watch?v={i}",
+         'file_name': f"video_{i}.mp4", 'file_size': 1024}
+        for i in range(3)
+    ]
+    downloads = record_downloads(db_session, records)
+
+    assert len(downloads) == 3
+    assert db_session.query(Download).filter_by(user_id=user.id).count() == 3
+    subscription = db_session.query(Subscription).filter_by(user_id=user.id).first()
+    assert subscription.daily_downloads_used == 3
+
+def test_complete_payment_only_once(db_session, user):
+    """Test a payment can't be completed twice."""
+    payment = Payment(user_id=user.id, amount=50000, plan=SubscriptionPlans.BRONZE,
+                      status=PaymentStatus.PENDING)
+    db_session.add(payment)
+    db_session.commit()
+
+    completed = complete_payment(db_session, payment.id, "MANUAL-1")
+
+    assert completed.status == PaymentStatus.COMPLETED
+    assert completed.transaction_id == "MANUAL-1"
+    assert complete_payment(db_session, payment.id, "MANUAL-2") is None
+    subscription = db_session.query(Subscription).filter_by(user_id=user.id).one()
+    assert subscription.plan == SubscriptionPlans.BRONZE
+
+def test_record_downloads_requires_subscription(db_session, user):
+    """Test bulk recording rejects users without an active subscription, like record_download."""
+    records = [{'user_id': user.id, 'file_url': "https://youtube.com/watch?v=1",
+                'file_name': "video_1.mp4", 'file_size': 1024}]
+
+    with pytest.raises(ValueError):
+        record_downloads(db_session, records)
+    assert db_session.query(Download).count() == 0
+
+@pytest.mark.asyncio
+async def test_batcher_writes_records_submitted_during_flush(db_session, user):
+    """Test a record submitted while a flush is writing goes out without another submit."""
+    db_session.add(Subscription(user_id=user.id, plan=SubscriptionPlans.FREE, is_active=True))
+    db_session.commit()
+
+    writing = threading.Event()
+    proceed = threading.Event()
+    def session_factory():
+        writing.set()
+        proceed.wait(5)
+        return TestingSessionLocal()
+
+    batcher = DownloadRecordBatcher(interval=0.01, session_factory=session_factory)
+    batcher.submit(user.id, "https://youtube.com/watch?v=1", "video_1.mp4", 1024)
+    await asyncio.to_thread(writing.wait, 5)
+
+    # The first flush is now inside its write
+    batcher.submit(user.id, "https://youtube.com/watch?v=2", "video_2.mp4", 1024)
+    proceed.set()
+    await asyncio.wait_for(batcher.close(), 5)
+
+    assert db_session.query(Download).filter_by(user_id=user.id).count() == 2
+    subscription = db_session.query(Subscription).filter_by(user_id=user.id).one()
+    assert subscription.daily_downloads_used == 2
+
+@pytest.mark.asyncio
+async def test_batcher_keeps_other_records_when_one_fails(db_session, user):
+    """Test a record the bulk write rejects doesn't take the rest of the batch with it."""
+    db_session.add(Subscription(user_id=user.id, plan=SubscriptionPlans.FREE, is_active=True))
+    db_session.commit()
+
+    batcher = DownloadRecordBatcher(interval=0.01, session_factory=TestingSessionLocal)
+    batcher.submit(user.id, "https://youtube.com/watch?v=1", "video_1.mp4", 1024)
+    # No such user, so no active subscription
+    batcher.submit(user.id + 1, "https://youtube.com/watch?v=2", "video_2.mp4", 1024)
+    await asyncio.wait_for(batcher.close(), 5)
+
+    assert db_session.query(Download).count() == 1
+    assert db_session.query(Download).one().user_id == user.id
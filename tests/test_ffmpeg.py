@@ -0,0 +1,18 @@
+from utils.ffmpeg import _parse_frame_rate, _video_bitrate
+
+def test_video_bitrate_leaves_room_for_audio():
+    """Test the video bitrate plus audio fills the target size in kbps."""
+    # 50 MB over 100 seconds is 4000 kbps in total
+    assert _video_bitrate(50_000_000, 100, 128) == 3872
+    assert _video_bitrate(50_000_000, 100, 0) == 4000
+
+def test_video_bitrate_never_negative():
+    """Test a budget smaller than the audio track yields zero, not a negative rate."""
+    assert _video_bitrate(1000, 100, 128) == 0
+
+def test_parse_frame_rate():
+    """Test ffprobe rate strings, including malformed ones."""
+    assert _parse_frame_rate('30000/1001') == 30000 / 1001
+    assert _parse_frame_rate('25') == 25.0
+    assert _parse_frame_rate('0/0') == 0.0
+    assert _parse_frame_rate('n/a') == 0.0
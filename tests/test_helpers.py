@@ -0,0 +1,24 @@
+from utils.helpers import create_progress_bar, parse_human_readable_size, PROGRESS_BARS, PROGRESS_BAR_STEPS
+
+def test_create_progress_bar_bounds():
+    """Test progress bar is empty at 0%, full at 100% and clamped outside."""
+    assert create_progress_bar(0) == "░" * PROGRESS_BAR_STEPS
+    assert create_progress_bar(100) == "▓" * PROGRESS_BAR_STEPS
+    assert create_progress_bar(-5) == PROGRESS_BARS[0]
+    assert create_progress_bar(150) == PROGRESS_BARS[-1]
+
+def test_create_progress_bar_steps():
+    """Test progress bar advances one block per 5%."""
+    assert create_progress_bar(4.9) == PROGRESS_BARS[0]
+    assert create_progress_bar(5) == PROGRESS_BARS[1]
+    assert create_progress_bar(52.5) == "▓" * 10 + "░" * 10
+    assert all(len(bar) == PROGRESS_BAR_STEPS for bar in PROGRESS_BARS)
+
+def test_parse_human_readable_size():
+    """Test sizes with and without units, and rejection of malformed input."""
+    assert parse_human_readable_size("1024") == 1024
+    assert parse_human_readable_size("1.5 KB") == 1536
+    assert parse_human_readable_size("700m") == 700 * 1024**2
+    assert parse_human_readable_size(" 2GB ") == 2 * 1024**3
+    assert parse_human_readable_size("12 parsecs") is None
+    assert parse_human_readable_size("") is None
@@ -1,21 +1,24 @@
-from .downloader import Downloader, DownloadError
-from .ffmpeg import FFmpegError, get_video_info, compress_video, add_watermark, get_supported_formats
-from .helpers import format_size, format_timedelta, get_readable_time, format_price, is_valid_url, truncate, parse_human_readable_size
+from .downloader import Downloader, DownloadError, downloader
+from .ffmpeg import FFmpegError, get_video_info, compress_video, compress_many, add_watermark, get_supported_formats
+from .helpers import format_size, create_progress_bar, format_timedelta, get_readable_time, format_price, is_valid_url, truncate, parse_human_readable_size
 
 __all__ = [
     # Downloader
     'Downloader',
     'DownloadError',
+    'downloader',
     
     # FFmpeg
     'FFmpegError',
     'get_video_info',
     'compress_video',
+    'compress_many',
     'add_watermark',
     'get_supported_formats',
     
     # Helpers
     'format_size',
+    'create_progress_bar',
     'format_timedelta',
     'get_readable_time',
     'format_price',
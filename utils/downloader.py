@@ -1,12 +1,19 @@
 import asyncio
+import glob
 import json
 import logging
 import os
 import re
-from typing import Dict, List, Optional, Any, Union
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Tuple, Union
 
 import yt_dlp
 
+from config import FORMATS_CACHE_SIZE, FORMATS_CACHE_TTL, YTDLP_DOWNLOAD_WORKERS, YTDLP_EXTRACT_WORKERS
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -30,19 +37,63 @@ class Downloader:
             'force_generic_extractor': False,
             'noplaylist': True,
         }
+        
+        # Blocking yt-dlp work runs on dedicated threads instead of the loop's
+        # default executor; info lookups and downloads don't share a queue
+        self._extract_executor = ThreadPoolExecutor(
+            max_workers=YTDLP_EXTRACT_WORKERS, thread_name_prefix="ytdlp-info"
+        )
+        self._download_executor = ThreadPoolExecutor(
+            max_workers=YTDLP_DOWNLOAD_WORKERS, thread_name_prefix="ytdlp-download"
+        )
+        
+        # YoutubeDL isn't thread-safe, so each info worker thread keeps its own;
+        # reusing it keeps yt-dlp's HTTP connections and TLS sessions warm
+        self._thread_local = threading.local()
+        self._info_ydls: List[yt_dlp.YoutubeDL] = []
+        self._info_ydls_lock = threading.Lock()
+        
+        # url -> (expiry, formats), least recently used first
+        self._formats_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        # url -> extraction in progress, shared by everyone asking for that url
+        self._formats_pending: Dict[str, asyncio.Future] = {}
+    
+    def close(self) -> None:
+        """Shut down the worker threads, waiting for running jobs to finish"""
+        self._extract_executor.shutdown(wait=True, cancel_futures=True)
+        self._download_executor.shutdown(wait=True, cancel_futures=True)
+        
+        with self._info_ydls_lock:
+            for ydl in self._info_ydls:
+                ydl.close()
+            self._info_ydls.clear()
     
     async def get_available_formats(self, url: str) -> List[Dict[str, Any]]:
-        """Get available formats for a given URL"""
+        """Get available formats for a given URL, reusing recent results"""
+        cached = self._formats_cache.get(url)
+        if cached and cached[0] > time.monotonic():
+            self._formats_cache.move_to_end(url)
+            return [dict(fmt) for fmt in cached[1]]
+        
+        # Concurrent requests for the same url wait on a single extraction
+        pending = self._formats_pending.get(url)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_formats(url))
+            self._formats_pending[url] = pending
+            pending.add_done_callback(lambda _: self._formats_pending.pop(url, None))
+        
+        # Shielded so one cancelled caller doesn't cancel the others' extraction
+        formats = await asyncio.shield(pending)
+        return [dict(fmt) for fmt in formats]
+    
+    async def _fetch_formats(self, url: str) -> List[Dict[str, Any]]:
+        """Extract the formats for a URL with yt-dlp and cache them"""
         try:
             # Run yt-dlp in a separate thread to avoid blocking
             loop = asyncio.get_event_loop()
             
             # Get video info
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                info = await loop.run_in_executor(
-                    None,
-                    lambda: ydl.extract_info(url, download=False)
-                )
+            info = await loop.run_in_executor(self._extract_executor, self._extract_info_sync, url)
             
             if not info:
                 raise DownloadError("Could not extract video information")
@@ -86,6 +137,11 @@ class Downloader:
                 
                 cleaned_formats.append(format_info)
             
+            self._formats_cache[url] = (time.monotonic() + FORMATS_CACHE_TTL, cleaned_formats)
+            self._formats_cache.move_to_end(url)
+            if len(self._formats_cache) > FORMATS_CACHE_SIZE:
+                self._formats_cache.popitem(last=False)
+            
             return cleaned_formats
             
         except yt_dlp.DownloadError as e:
@@ -119,33 +175,8 @@ class Downloader:
             # Run download in a separate thread
             loop = asyncio.get_event_loop()
             
-            with yt_dlp.YoutubeDL(download_opts) as ydl:
-                # First get the info to determine the output filename
-                info = await loop.run_in_executor(
-                    None,
-                    lambda: ydl.extract_info(url, download=False)
-                )
-                
-                if not info:
-                    raise DownloadError("Could not extract video information")
-                
-                # Handle playlists
-                if 'entries' in info:
-                    if not info['entries']:
-                        raise DownloadError("No videos found in playlist")
-                    info = info['entries'][0]
-                
-                # Get the output filename
-                output_path = ydl.prepare_filename(info)
-                
-                # Start the download
-                await loop.run_in_executor(
-                    None,
-                    lambda: ydl.download([url])
-                )
-                
-                return output_path
-                
+            return await loop.run_in_executor(self._download_executor, self._download_sync, url, download_opts)
+            
         except yt_dlp.DownloadError as e:
             logger.error(f"Download error: {str(e)}")
             raise DownloadError(f"خطا در دانلود ویدیو: {str(e)}")
@@ -153,6 +184,47 @@ class Downloader:
             logger.error(f"Unexpected download error: {str(e)}", exc_info=True)
             raise DownloadError(f"خطای ناشناخته در دانلود: {str(e)}")
     
+    def _info_ydl(self) -> yt_dlp.YoutubeDL:
+        """Get the calling worker thread's YoutubeDL, creating it on first use"""
+        ydl = getattr(self._thread_local, 'ydl', None)
+        if ydl is None:
+            ydl = self._thread_local.ydl = yt_dlp.YoutubeDL(self.ydl_opts)
+            with self._info_ydls_lock:
+                self._info_ydls.append(ydl)
+        return ydl
+    
+    def _extract_info_sync(self, url: str) -> Optional[Dict[str, Any]]:
+        """Extract info with the thread's YoutubeDL; blocking, runs in a worker thread"""
+        return self._info_ydl().extract_info(url, download=False)
+    
+    def _download_sync(self, url: str, download_opts: Dict[str, Any]) -> str:
+        """Create a YoutubeDL and download; blocking, runs in a worker thread"""
+        with yt_dlp.YoutubeDL(download_opts) as ydl:
+            # Extract and download in one go; a separate info pass would
+            # fetch the page and format manifests twice
+            info = ydl.extract_info(url, download=True)
+            
+            if not info:
+                raise DownloadError("Could not extract video information")
+            
+            # Handle playlists
+            if 'entries' in info:
+                if not info['entries']:
+                    raise DownloadError("No videos found in playlist")
+                info = info['entries'][0]
+            
+            # yt-dlp records where each file ended up, after merging and remuxing
+            requested = info.get('requested_downloads')
+            if requested and requested[-1].get('filepath'):
+                return requested[-1]['filepath']
+            
+            # Older extractors: the extension may differ from the template's guess
+            stem = os.path.splitext(ydl.prepare_filename(info))[0]
+            matches = glob.glob(f"{glob.escape(stem)}.*")
+            if not matches:
+                raise DownloadError("Downloaded file not found")
+            return matches[0]
+    
     def _get_resolution(self, fmt: Dict[str, Any]) -> str:
         """Get resolution string from format info"""
         if fmt.get('resolution'):
@@ -179,3 +251,7 @@ class Downloader:
         
         # Default to SD if no resolution found
         return 'SD'
+
+
+# Shared downloader instance; its yt-dlp options are built once per process
+downloader = Downloader()
@@ -1,8 +1,20 @@
 import asyncio
 import logging
 import os
+import hashlib
 import subprocess
-from typing import Optional, Tuple, List, Dict, Any
+import tempfile
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Optional, Tuple, List, Dict, Any, Callable
+
+from config import FFMPEG_GPU_SESSIONS, FFMPEG_HWACCEL, VAAPI_DEVICE
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    from json import loads as json_loads
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -11,42 +23,286 @@ class FFmpegError(Exception):
     """Custom exception for FFmpeg related errors"""
     pass
 
+# libx264 already spreads one encode over several cores, so half the cores in
+# concurrent encodes keeps them busy without starving the event loop's process
+FFMPEG_MAX_CONCURRENT = max(1, (os.cpu_count() or 2) // 2)
+_cpu_slots = asyncio.Semaphore(FFMPEG_MAX_CONCURRENT)
+# GPU encoders are limited by the driver's session count instead
+_gpu_slots = asyncio.Semaphore(FFMPEG_GPU_SESSIONS)
+
+# Each concurrent encode gets an equal share of the cores; with -threads 0 every
+# job would start a thread per core and the jobs would fight over them
+FFMPEG_THREADS_PER_JOB = max(1, (os.cpu_count() or 2) // FFMPEG_MAX_CONCURRENT)
+FFMPEG_THREAD_ARGS = [
+    '-threads', str(FFMPEG_THREADS_PER_JOB),
+    '-filter_threads', str(FFMPEG_THREADS_PER_JOB),
+]
+
+# First-pass stats don't depend on the target bitrate, so two-pass encodes of the
+# same source to several sizes share one pass log
+PASS1_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'beast_pass1_cache')
+PASS1_CACHE_TTL = 24 * 3600  # seconds
+_pass1_locks: Dict[str, asyncio.Lock] = {}
+_pass1_lock_users: Dict[str, int] = {}
+
+
+def _pass1_log_prefix(input_path: str, preset: str, tune: Optional[str] = None) -> str:
+    """Get the shared pass log prefix for an input file and encoder settings"""
+    st = os.stat(input_path)
+    key = f"{os.path.realpath(input_path)}:{st.st_mtime_ns}:{st.st_size}:{preset}:{tune}"
+    return os.path.join(PASS1_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest())
+
+
+def _claim_pass1_log(prefix: str) -> bool:
+    """Check for a pass log younger than PASS1_CACHE_TTL and refresh its mtime
+    
+    The refreshed mtime keeps other jobs' evictions off the log until pass 2 has read it.
+    """
+    log_path = f"{prefix}-0.log"
+    try:
+        if time.time() - os.stat(log_path).st_mtime >= PASS1_CACHE_TTL:
+            return False
+        for path in (log_path, f"{log_path}.mbtree"):
+            os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _evict_pass1_cache() -> None:
+    """Remove pass logs older than PASS1_CACHE_TTL"""
+    cutoff = time.time() - PASS1_CACHE_TTL
+    with os.scandir(PASS1_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+# libx264 -tune values accepted by the encode helpers
+X264_TUNES = frozenset({'film', 'animation', 'grain', 'stillimage', 'fastdecode', 'zerolatency'})
+
+# GPU H.264 encoder for each hardware acceleration method, in detection order
+HWACCEL_ENCODERS = {
+    'cuda': 'h264_nvenc',
+    'vaapi': 'h264_vaapi',
+    'qsv': 'h264_qsv',
+}
+
+
+def _encoder_works(hwaccel: str) -> bool:
+    """Encode a few blank frames; a compiled-in encoder may still have no device"""
+    if hwaccel == 'vaapi' and not os.path.exists(VAAPI_DEVICE):
+        return False
+    
+    input_args, codec_args, upload_filter = _h264_args(hwaccel, 23, 'medium')
+    cmd = [
+        'ffmpeg', '-hide_banner', '-v', 'error',
+        *input_args,
+        '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+        *_video_filter_args([], upload_filter),
+        *codec_args,
+        '-f', 'null', '-',
+    ]
+    
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+@lru_cache(maxsize=1)
+def detect_hwaccel() -> Optional[str]:
+    """Get the usable hardware acceleration method, probed once per process"""
+    if FFMPEG_HWACCEL == 'none':
+        return None
+    
+    # A specific method may be forced, otherwise try them all
+    candidates = HWACCEL_ENCODERS if FFMPEG_HWACCEL == 'auto' else [FFMPEG_HWACCEL]
+    for hwaccel in candidates:
+        if hwaccel not in HWACCEL_ENCODERS:
+            logger.warning(f"Unknown FFMPEG_HWACCEL value: {hwaccel}")
+            continue
+        try:
+            if _encoder_works(hwaccel):
+                logger.info(f"Using {HWACCEL_ENCODERS[hwaccel]} for video encoding")
+                return hwaccel
+        except Exception as e:
+            logger.warning(f"Could not probe {HWACCEL_ENCODERS[hwaccel]}: {str(e)}")
+    
+    return None
+
+
+# AAC encoders preferred over FFmpeg's native one; aac_at only exists on macOS builds
+AAC_ENCODERS = ('libfdk_aac', 'aac_at')
+
+
+@lru_cache(maxsize=1)
+def detect_aac_encoder() -> str:
+    """Get the best AAC encoder this FFmpeg build has, queried once per process"""
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True
+        )
+    except Exception as e:
+        logger.warning(f"Could not list FFmpeg encoders: {str(e)}")
+        return 'aac'
+    
+    # Lines look like " A....D libfdk_aac           Fraunhofer FDK AAC"
+    available = {parts[1] for parts in map(str.split, result.stdout.splitlines()) if len(parts) >= 2}
+    for encoder in AAC_ENCODERS:
+        if encoder in available:
+            logger.info(f"Using {encoder} for audio encoding")
+            return encoder
+    
+    return 'aac'
+
+
+def _h264_args(
+    hwaccel: Optional[str],
+    crf: int,
+    preset: str,
+    tune: Optional[str] = None
+) -> Tuple[List[str], List[str], Optional[str]]:
+    """Get FFmpeg arguments for an H.264 encode
+    
+    The content tune only applies to libx264; GPU encoders have their own tuning.
+    
+    Returns:
+        Tuple of (input args, codec args, filter to append to the -vf chain or None)
+    """
+    if hwaccel == 'cuda':
+        # Decode on the GPU too; frames are copied back only if a CPU filter needs them
+        return ['-hwaccel', 'cuda'], [
+            '-c:v', 'h264_nvenc',
+            '-preset', 'p4',
+            '-tune', 'hq',
+            '-rc', 'vbr',
+            '-cq', str(crf),
+        ], None
+    
+    if hwaccel == 'vaapi':
+        # CPU filters run first, then frames are uploaded for the encoder
+        return ['-vaapi_device', VAAPI_DEVICE], [
+            '-c:v', 'h264_vaapi',
+            '-qp', str(crf),
+        ], 'format=nv12,hwupload'
+    
+    if hwaccel == 'qsv':
+        return [], [
+            '-c:v', 'h264_qsv',
+            '-preset', preset,
+            '-global_quality', str(crf),
+        ], None
+    
+    return [], ['-c:v', 'libx264', '-preset', preset, *_x264_tune_args(tune), '-crf', str(crf)], None
+
+
+def _x264_tune_args(tune: Optional[str]) -> List[str]:
+    """Get the libx264 -tune option, if any"""
+    if not tune:
+        return []
+    if tune not in X264_TUNES:
+        raise FFmpegError(f"Unknown x264 tune: {tune}")
+    return ['-tune', tune]
+
+
+def _video_filter_args(filters: List[str], upload_filter: Optional[str]) -> List[str]:
+    """Join video filters into a single -vf option, the upload filter last"""
+    if upload_filter:
+        filters = [*filters, upload_filter]
+    return ['-vf', ','.join(filters)] if filters else []
+
+def _mp4_movflags(faststart: bool) -> List[str]:
+    """Get MP4 muxer flags
+    
+    faststart moves the index to the front so players can start before the
+    download ends, but costs a rewrite of the whole file after encoding.
+    Fragmented MP4 streams just as well and is written in a single pass.
+    """
+    if faststart:
+        return ['-movflags', '+faststart']
+    return ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+
+# Audio codecs the MP4 muxer takes as-is when remuxing
+MP4_COPY_AUDIO_CODECS = frozenset({'aac', 'mp3'})
+
+# Containers (by file extension) whose H.264 streams can be remuxed into MP4
+MP4_FAMILY_FORMATS = frozenset({'mp4', 'm4v', 'mov'})
+
+def _is_mp4_h264(video_info: Dict[str, Any]) -> bool:
+    """Check if a probed file is H.264 in an MP4-family container, so it can be remuxed"""
+    return video_info['codec'] == 'h264' and video_info['format'] in MP4_FAMILY_FORMATS
+
+def _remux_audio_args(video_info: Dict[str, Any], remove_audio: bool = False) -> List[str]:
+    """Get audio arguments for an MP4 remux: copy when possible, otherwise convert to AAC"""
+    if remove_audio or not video_info['audio_codec']:
+        return ['-an']
+    if video_info['audio_codec'] in MP4_COPY_AUDIO_CODECS:
+        return ['-c:a', 'copy']
+    return ['-c:a', detect_aac_encoder(), '-b:a', '128k']
+
+def _video_bitrate(target_size: int, duration: float, audio_bitrate: int) -> int:
+    """Get the video bitrate in kbps that fills target_size bytes alongside the audio"""
+    total_kbps = target_size * 8 / 1000 / duration
+    return max(0, int(total_kbps - audio_bitrate))
+
+def _parse_frame_rate(rate: str) -> float:
+    """Parse an ffprobe rate such as '30000/1001'; a bare number is also accepted"""
+    num, _, den = rate.partition('/')
+    try:
+        den_value = int(den) if den else 1
+        return int(num) / den_value if den_value else 0.0
+    except ValueError:
+        return 0.0
+
 def get_video_info(file_path: str) -> Dict[str, Any]:
-    """Get video information using ffprobe"""
+    """Get video information using ffprobe, cached while the file is unchanged"""
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        logger.error(f"FFprobe error: {str(e)}")
+        raise FFmpegError(f"خطا در دریافت اطلاعات ویدیو: {str(e)}")
+    
+    # Callers get their own copy so nothing can alter the cached entry
+    return dict(_probe_video(file_path, st.st_mtime_ns, st.st_size))
+
+@lru_cache(maxsize=128)
+def _probe_video(file_path: str, mtime_ns: int, size: int) -> Dict[str, Any]:
+    """Run ffprobe; mtime and size are part of the cache key so rewrites are probed again"""
     try:
         cmd = [
             'ffprobe',
             '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height,duration,r_frame_rate,codec_name',
-            '-show_entries', 'format=size,duration',
+            # One entry spec for both sections; only these keys are serialised
+            '-show_entries', 'stream=codec_type,width,height,duration,r_frame_rate,codec_name:format=size,duration',
             '-of', 'json',
             file_path
         ]
         
+        # Keep stdout as bytes; orjson parses them without decoding first
         result = subprocess.run(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
             check=True
         )
         
-        import json
-        info = json.loads(result.stdout)
+        info = json_loads(result.stdout)
         
-        if not info.get('streams') or not info.get('format'):
+        streams = info.get('streams') or []
+        stream = next((st for st in streams if st.get('codec_type') == 'video'), None)
+        if not stream or not info.get('format'):
             raise FFmpegError("Could not get video information")
         
-        stream = info['streams'][0]
+        audio_stream = next((st for st in streams if st.get('codec_type') == 'audio'), {})
         format_info = info['format']
         
-        # Calculate FPS
-        fps = 0
-        if 'r_frame_rate' in stream:
-            num, den = map(int, stream['r_frame_rate'].split('/'))
-            if den != 0:
-                fps = num / den
+        fps = _parse_frame_rate(stream.get('r_frame_rate', '0/1'))
         
         return {
             'width': int(stream.get('width', 0)),
@@ -54,17 +310,139 @@ def get_video_info(file_path: str) -> Dict[str, Any]:
             'duration': float(stream.get('duration', format_info.get('duration', 0))),
             'fps': fps,
             'codec': stream.get('codec_name', 'unknown'),
+            'audio_codec': audio_stream.get('codec_name'),
             'size': int(format_info.get('size', 0)),
             'format': os.path.splitext(file_path)[1].lstrip('.').lower()
         }
         
     except subprocess.CalledProcessError as e:
-        logger.error(f"FFprobe error: {e.stderr}")
-        raise FFmpegError(f"خطا در دریافت اطلاعات ویدیو: {e.stderr}")
+        stderr = e.stderr.decode(errors='replace')
+        logger.error(f"FFprobe error: {stderr}")
+        raise FFmpegError(f"خطا در دریافت اطلاعات ویدیو: {stderr}")
     except Exception as e:
         logger.error(f"Unexpected error in get_video_info: {str(e)}", exc_info=True)
         raise FFmpegError(f"خطای ناشناخته در پردازش ویدیو: {str(e)}")
 
+# FFmpeg writes progress to stderr for the whole encode; only the end of it
+# is useful for error reports
+STDERR_CHUNK_SIZE = 4096
+STDERR_TAIL_CHUNKS = 16  # 64 KB
+
+async def _drain_stderr(stream: asyncio.StreamReader) -> bytes:
+    """Read a stream to EOF, keeping only its last STDERR_TAIL_CHUNKS chunks"""
+    tail = deque(maxlen=STDERR_TAIL_CHUNKS)
+    while chunk := await stream.read(STDERR_CHUNK_SIZE):
+        tail.append(chunk)
+    return b''.join(tail)
+
+async def _read_progress(stream: asyncio.StreamReader, on_progress: Optional[Callable[[float], None]]) -> None:
+    """Read FFmpeg's key=value progress output, reporting seconds encoded so far"""
+    while line := await stream.readline():
+        key, _, value = line.decode(errors='replace').strip().partition('=')
+        # out_time_us is "N/A" until the first frame is written
+        if key == 'out_time_us' and on_progress and value.isdigit():
+            on_progress(int(value) / 1_000_000)
+
+async def _run_ffmpeg(
+    cmd: List[str],
+    hwaccel: Optional[str],
+    error_message: str,
+    on_progress: Optional[Callable[[float], None]] = None,
+    timeout: Optional[float] = None
+) -> None:
+    """Run an FFmpeg command once a CPU or GPU encode slot is free
+    
+    Args:
+        cmd: FFmpeg command, starting with the executable
+        hwaccel: Hardware acceleration method the command encodes with, or None
+        error_message: Prefix for the FFmpegError message
+        on_progress: Called with the seconds of output encoded so far
+        timeout: Seconds after which a still-running FFmpeg is killed
+    
+    Raises:
+        FFmpegError: If FFmpeg exits with an error or times out
+    """
+    # Machine-readable progress on stdout instead of the stats line on stderr
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    
+    async with (_gpu_slots if hwaccel else _cpu_slots):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        # Wait for process to complete while keeping both pipes drained
+        try:
+            stderr, _, _ = await asyncio.wait_for(
+                asyncio.gather(
+                    _drain_stderr(process.stderr),
+                    _read_progress(process.stdout, on_progress),
+                    process.wait()
+                ),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            # A stalled encode must not hold its slot forever
+            process.kill()
+            await process.wait()
+            logger.error(f"FFmpeg timed out after {timeout:.0f}s: {' '.join(cmd)}")
+            raise FFmpegError(f"{error_message}: زمان پردازش به پایان رسید")
+        except asyncio.CancelledError:
+            process.kill()
+            # Reap the child even if the caller is cancelled again while waiting
+            await asyncio.shield(process.wait())
+            raise
+    
+    if process.returncode != 0:
+        stderr = stderr.decode(errors='replace')
+        logger.error(f"FFmpeg error: {stderr}")
+        raise FFmpegError(f"{error_message}: {stderr}")
+
+async def _run_pass1(
+    input_path: str,
+    preset: str,
+    tune: Optional[str],
+    target_bitrate: int,
+    timeout: Optional[float] = None
+) -> str:
+    """Run the libx264 analysis pass unless a recent pass log for the input exists
+    
+    Returns the pass log prefix for the second pass.
+    """
+    os.makedirs(PASS1_CACHE_DIR, exist_ok=True)
+    prefix = _pass1_log_prefix(input_path, preset, tune)
+    
+    # Jobs on the same source wait for one analysis instead of racing on the log
+    lock = _pass1_locks.setdefault(prefix, asyncio.Lock())
+    _pass1_lock_users[prefix] = _pass1_lock_users.get(prefix, 0) + 1
+    try:
+        async with lock:
+            if _claim_pass1_log(prefix):
+                return prefix
+            
+            await asyncio.to_thread(_evict_pass1_cache)
+            cmd = [
+                'ffmpeg', '-y', '-i', input_path,
+                '-c:v', 'libx264',
+                '-preset', preset,
+                *_x264_tune_args(tune),
+                '-b:v', f'{target_bitrate}k',
+                '-passlogfile', prefix,
+                '-pass', '1',
+                *FFMPEG_THREAD_ARGS,
+                '-an',
+                '-f', 'null', os.devnull
+            ]
+            await _run_ffmpeg(cmd, None, "خطا در فشرده‌سازی ویدیو", timeout=timeout)
+            return prefix
+    finally:
+        # Drop the lock once no other job is waiting on it
+        _pass1_lock_users[prefix] -= 1
+        if not _pass1_lock_users[prefix]:
+            del _pass1_lock_users[prefix]
+            del _pass1_locks[prefix]
+
 async def compress_video(
     input_path: str,
     output_path: str,
@@ -73,6 +451,11 @@ async def compress_video(
     max_bitrate: int = 2000,  # kbps
     preset: str = 'medium',
     crf: int = 23,
+    strict_size: bool = False,
+    faststart: bool = True,
+    tune: Optional[str] = None,
+    audio_bitrate: int = 128,  # kbps
+    progress_callback: Optional[Callable[[float], None]] = None,
 ) -> str:
     """
     Compress video to fit target size while maintaining quality
@@ -85,63 +468,100 @@ async def compress_video(
         max_bitrate: Maximum bitrate in kbps
         preset: FFmpeg preset (ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow)
         crf: Constant Rate Factor (18-28 is good, lower is better quality)
+        strict_size: Use a slower two-pass libx264 encode that hits the target bitrate exactly
+        faststart: Rewrite the output with its index first; False writes fragmented MP4 instead
+        tune: libx264 content tune (film, animation, grain, ...); ignored by GPU encoders
+        audio_bitrate: Audio bitrate in kbps, taken out of the size budget
+        progress_callback: Called with the percentage (0-100) of the video encoded
     
     Returns:
         Path to compressed video
     """
     try:
-        # Get video info
-        video_info = get_video_info(input_path)
+        # Get video info; ffprobe blocks, so keep it off the event loop
+        video_info = await asyncio.to_thread(get_video_info, input_path)
         duration = video_info['duration']
         
         if duration <= 0:
             raise FFmpegError("مدت زمان ویدیو نامعتبر است")
         
+        # Generous for slow presets, but a hung FFmpeg still gets killed
+        timeout = max(60, duration * 10)
+        
+        # Already fits and already H.264: remux with the requested MP4 flags instead of encoding
+        if video_info['size'] <= target_size and _is_mp4_h264(video_info):
+            audio_args = await asyncio.to_thread(_remux_audio_args, video_info)
+            cmd = [
+                'ffmpeg', '-y', '-i', input_path,
+                '-c:v', 'copy', *audio_args,
+                *_mp4_movflags(faststart),
+                '-f', 'mp4',
+                output_path
+            ]
+            await _run_ffmpeg(cmd, None, "خطا در فشرده‌سازی ویدیو", timeout=timeout)
+            return output_path
+        
         # Calculate target bitrate (in kbps)
-        target_bitrate = int((target_size * 8) / (1_048_576 * duration))  # Convert to kbps
+        target_bitrate = _video_bitrate(target_size, duration, audio_bitrate)
         target_bitrate = max(min(target_bitrate, max_bitrate), min_bitrate)
         
-        # Prepare FFmpeg command
-        cmd = [
-            'ffmpeg',
-            '-y',  # Overwrite output file if it exists
-            '-i', input_path,
-            '-c:v', 'libx264',
-            '-preset', preset,
-            '-crf', str(crf),
-            '-b:v', f'{target_bitrate}k',
-            '-maxrate', f'{int(target_bitrate * 1.2)}k',  # Maximum bitrate (with 20% buffer)
-            '-bufsize', f'{int(target_bitrate * 2)}k',    # Buffer size (2x target bitrate)
-            '-movflags', '+faststart',  # For web streaming
-            '-threads', '0',  # Use all available threads
-            '-pass', '1',
-            '-f', 'mp4',
-            output_path
-        ]
+        aac_encoder = await asyncio.to_thread(detect_aac_encoder)
+        
+        if strict_size:
+            hwaccel = None
+            passlog_prefix = await _run_pass1(input_path, preset, tune, target_bitrate, timeout)
+            # Two-pass average bitrate, reading the shared first-pass stats
+            cmd = [
+                'ffmpeg', '-y', '-i', input_path,
+                '-c:v', 'libx264',
+                '-preset', preset,
+                *_x264_tune_args(tune),
+                '-b:v', f'{target_bitrate}k',
+                '-passlogfile', passlog_prefix,
+                '-pass', '2',
+                '-c:a', aac_encoder,
+                '-b:a', f'{audio_bitrate}k',
+                *_mp4_movflags(faststart),
+                *FFMPEG_THREAD_ARGS,
+                '-f', 'mp4',
+                output_path
+            ]
+        else:
+            # Single pass: constant quality, capped by the VBV so it still fits the target
+            hwaccel = await asyncio.to_thread(detect_hwaccel)
+            input_args, codec_args, upload_filter = _h264_args(hwaccel, crf, preset, tune)
+            cmd = [
+                'ffmpeg',
+                '-y',  # Overwrite output file if it exists
+                *input_args,
+                '-i', input_path,
+                *codec_args,
+                *_video_filter_args([], upload_filter),
+                '-maxrate', f'{target_bitrate}k',
+                '-bufsize', f'{target_bitrate * 2}k',
+                '-c:a', aac_encoder,
+                '-b:a', f'{audio_bitrate}k',
+                *_mp4_movflags(faststart),  # For web streaming
+                *FFMPEG_THREAD_ARGS,  # This job's share of the cores
+                '-f', 'mp4',
+                output_path
+            ]
         
         # Run FFmpeg
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        # Wait for process to complete
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            logger.error(f"FFmpeg error: {stderr.decode()}")
-            raise FFmpegError(f"خطا در فشرده‌سازی ویدیو: {stderr.decode()}")
-        
-        # Check output file
-        if not os.path.exists(output_path):
+        on_progress = None
+        if progress_callback:
+            on_progress = lambda seconds: progress_callback(min(100.0, seconds * 100 / duration))
+        await _run_ffmpeg(cmd, hwaccel, "خطا در فشرده‌سازی ویدیو", on_progress, timeout)
+        
+        # Check output file and get its size with a single stat
+        try:
+            output_size = os.stat(output_path).st_size
+        except FileNotFoundError:
             raise FFmpegError("خطا در ایجاد فایل خروجی")
         
-        # Get output file size
-        output_size = os.path.getsize(output_path)
-        
         # If output is still too large, try again with lower quality
-        if output_size > target_size * 1.1:  # 10% tolerance
+        # (two-pass output is bitrate-driven, so CRF has no effect there)
+        if not strict_size and output_size > target_size * 1.1:  # 10% tolerance
             logger.info(f"Output size {output_size} > target {target_size}, retrying with lower quality...")
             os.remove(output_path)  # Remove failed attempt
             return await compress_video(
@@ -151,20 +571,36 @@ async def compress_video(
                 min_bitrate,
                 max_bitrate,
                 preset,
-                min(crf + 2, 28)  # Increase CRF (lower quality) for next attempt
+                min(crf + 2, 28),  # Increase CRF (lower quality) for next attempt
+                faststart=faststart,
+                tune=tune,
+                audio_bitrate=audio_bitrate,
+                progress_callback=progress_callback
             )
         
         return output_path
         
     except Exception as e:
         logger.error(f"Error in compress_video: {str(e)}", exc_info=True)
-        if os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except:
-                pass
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
         raise FFmpegError(f"خطا در پردازش ویدیو: {str(e)}")
 
+async def compress_many(jobs: List[Dict[str, Any]]) -> List[str]:
+    """
+    Compress several videos concurrently
+    
+    Args:
+        jobs: Keyword arguments for each compress_video call
+    
+    Returns:
+        Paths to the compressed videos, in job order
+    """
+    # The encode slots bound how many FFmpeg processes actually run at once
+    return await asyncio.gather(*(compress_video(**job) for job in jobs))
+
 async def add_watermark(
     input_path: str,
     output_path: str,
@@ -200,45 +636,44 @@ async def add_watermark(
         overlay_pos = position_map.get(position.lower(), position_map['bottom-right'])
         
         # Prepare FFmpeg command
+        hwaccel = await asyncio.to_thread(detect_hwaccel)
+        input_args, codec_args, upload_filter = _h264_args(hwaccel, 23, 'medium')
+        drawtext = (
+            f"drawtext=text='{watermark_text}':"
+            f"fontcolor=white@0.6:fontsize={font_size}:"
+            f"x={overlay_pos}:"
+            f"box=1:boxcolor=black@0.3:boxborderw=5"
+        )
         cmd = [
             'ffmpeg',
             '-y',
+            *input_args,
             '-i', input_path,
-            '-vf', (
-                f"drawtext=text='{watermark_text}':"
-                f"fontcolor=white@0.6:fontsize={font_size}:"
-                f"x={overlay_pos}:"
-                f"box=1:boxcolor=black@0.3:boxborderw=5"
-            ),
+            *codec_args,
+            *_video_filter_args([drawtext], upload_filter),
+            *FFMPEG_THREAD_ARGS,
             '-codec:a', 'copy',  # Copy audio without re-encoding
             output_path
         ]
         
         # Run FFmpeg
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        # Wait for process to complete
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            logger.error(f"FFmpeg error: {stderr.decode()}")
-            raise FFmpegError(f"خطا در اضافه کردن واترمارک: {stderr.decode()}")
+        await _run_ffmpeg(cmd, hwaccel, "خطا در اضافه کردن واترمارک")
         
         return output_path
         
     except Exception as e:
         logger.error(f"Error in add_watermark: {str(e)}", exc_info=True)
-        if os.path.exists(output_path):
-            try:
-                os.remove(output_path)
-            except:
-                pass
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
         raise FFmpegError(f"خطا در پردازش ویدیو: {str(e)}")
 
+# process_video stops lowering the bitrate here rather than encoding garbage
+PROCESS_MIN_BITRATE = 100  # kbps
+# x264 preset for process_video's re-encodes (and QSV's, which shares the names)
+PROCESS_PRESET = 'veryfast'
+
 def process_video(
     input_path: str,
     output_path: str,
@@ -249,7 +684,8 @@ def process_video(
     format: str = 'mp4',
     remove_audio: bool = False,
     add_watermark: bool = False,
-    watermark_text: str = None
+    watermark_text: str = None,
+    faststart: bool = True
 ) -> str:
     """
     Process a video file with various options.
@@ -265,81 +701,106 @@ def process_video(
         remove_audio: Whether to remove audio track
         add_watermark: Whether to add a watermark
         watermark_text: Text to use as watermark
+        faststart: For MP4, rewrite the output with its index first; False writes fragmented MP4
         
     Returns:
         Path to processed video file
     """
     try:
-        # Get video info
-        video_info = get_video_info(input_path)
-        
-        # Build FFmpeg command
-        cmd = [
+        # The probe only decides whether a remux is possible, so skip it
+        # when the options, extension or size already rule one out
+        extension = os.path.splitext(input_path)[1].lstrip('.').lower()
+        can_remux = (format == 'mp4' and
+                     extension in MP4_FAMILY_FORMATS and
+                     not resolution and
+                     not (add_watermark and watermark_text) and
+                     os.stat(input_path).st_size <= max_size)
+        
+        # Already H.264 MP4 within the limits and nothing to draw: remux instead of re-encoding
+        video_info = get_video_info(input_path) if can_remux else None
+        if video_info and _is_mp4_h264(video_info):
+            subprocess.run(
+                ['ffmpeg', '-y', '-i', input_path,
+                 '-c:v', 'copy', *_remux_audio_args(video_info, remove_audio),
+                 *_mp4_movflags(faststart),
+                 '-f', format, output_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                check=True
+            )
+            
+            if not os.path.isfile(output_path):
+                raise FFmpegError("Output file was not created")
+            return output_path
+        
+        # Build FFmpeg command; only the rate cap changes between attempts.
+        # veryfast: the rate cap, not the preset, decides the size here.
+        # Always libx264: this synchronous path can't take a GPU slot
+        input_args, codec_args, upload_filter = _h264_args(None, 23, PROCESS_PRESET)
+        head = [
             'ffmpeg',
             '-y',  # Overwrite output file if it exists
+            *input_args,
             '-i', input_path,
+            *codec_args,
+            *FFMPEG_THREAD_ARGS,  # This job's share of the cores
         ]
-        
-        # Video codec options
-        cmd.extend([
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '23',
-            '-maxrate', f'{max_bitrate}k',
-            '-bufsize', f'{max_bitrate * 2}k',
-        ])
+        tail = []
         
         # Handle resolution
+        filters = []
         if resolution:
-            cmd.extend(['-vf', f'scale={resolution}'])
+            filters.append(f'scale={resolution}')
             
         # Handle audio
         if remove_audio:
-            cmd.extend(['-an'])
+            tail.extend(['-an'])
         else:
-            cmd.extend(['-c:a', 'aac', '-b:a', '128k'])
+            tail.extend(['-c:a', detect_aac_encoder(), '-b:a', '128k'])
             
         # Add watermark if requested
         if add_watermark and watermark_text:
             # Simple centered watermark
-            cmd.extend([
-                '-vf', f"drawtext=text='{watermark_text}':x=(w-text_w)/2:y=(h-text_h)/2:fontsize=24:fontcolor=white@0.5:box=1:boxcolor=black@0.5"
-            ])
+            filters.append(f"drawtext=text='{watermark_text}':x=(w-text_w)/2:y=(h-text_h)/2:fontsize=24:fontcolor=white@0.5:box=1:boxcolor=black@0.5")
+        
+        tail.extend(_video_filter_args(filters, upload_filter))
             
         # Set output format and path
-        cmd.extend(['-f', format, output_path])
-        
-        # Run FFmpeg
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        
-        # Verify output file
-        if not os.path.exists(output_path):
-            raise FFmpegError("Output file was not created")
+        if format == 'mp4':
+            tail.extend(_mp4_movflags(faststart))
+        tail.extend(['-f', format, output_path])
+        
+        while True:
+            cmd = [
+                *head,
+                '-maxrate', f'{max_bitrate}k',
+                '-bufsize', f'{max_bitrate * 2}k',
+                *tail,
+            ]
             
-        # Check output size
-        output_size = os.path.getsize(output_path)
-        if output_size > max_size:
-            # If output is too big, try again with lower quality
-            return process_video(
-                input_path,
-                output_path,
-                max_size,
-                max_duration,
-                int(max_bitrate * 0.8),  # Reduce bitrate
-                resolution,
-                format,
-                remove_audio,
-                add_watermark,
-                watermark_text
+            # Run FFmpeg
+            subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                check=True
             )
             
-        return output_path
+            # Verify output file and check its size with a single stat
+            try:
+                output_size = os.stat(output_path).st_size
+            except FileNotFoundError:
+                raise FFmpegError("Output file was not created")
+            if output_size <= max_size:
+                return output_path
+            
+            if max_bitrate <= PROCESS_MIN_BITRATE:
+                raise FFmpegError(f"Output is {output_size} bytes even at {max_bitrate} kbps")
+            
+            # If output is too big, try again with lower quality
+            max_bitrate = max(PROCESS_MIN_BITRATE, int(max_bitrate * 0.8))
         
     except subprocess.CalledProcessError as e:
         logger.error(f"FFmpeg error: {e.stderr}")
@@ -349,27 +810,33 @@ def process_video(
         raise FFmpegError(f"Video processing failed: {str(e)}")
 
 
+@lru_cache(maxsize=1)
+def _ffmpeg_formats() -> Tuple[str, ...]:
+    """Query ffmpeg once per process; the format list can't change while we run"""
+    # Run ffmpeg -formats
+    result = subprocess.run(
+        ['ffmpeg', '-formats'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True
+    )
+    
+    # Parse output to get supported formats
+    formats = []
+    for line in result.stdout.split('\n'):
+        if line.startswith('  '):
+            parts = line.strip().split()
+            if len(parts) >= 2 and parts[0] in ['DE', 'D', 'E']:
+                formats.append(parts[1])
+    
+    return tuple(formats)
+
+
 def get_supported_formats() -> list:
     """Get list of supported video/audio formats"""
     try:
-        # Run ffmpeg -formats
-        result = subprocess.run(
-            ['ffmpeg', '-formats'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        
-        # Parse output to get supported formats
-        formats = []
-        for line in result.stdout.split('\n'):
-            if line.startswith('  '):
-                parts = line.strip().split()
-                if len(parts) >= 2 and parts[0] in ['DE', 'D', 'E']:
-                    formats.append(parts[1])
-        
-        return formats
+        return list(_ffmpeg_formats())
         
     except Exception as e:
         logger.error(f"Error getting supported formats: {str(e)}")
@@ -19,6 +19,17 @@ def format_size(size_bytes: Union[int, float, None]) -> str:
     
     return f"{size_bytes:.1f} {units[i]}"
 
+# Progress bars for every 5% step, rendered once at import
+PROGRESS_BAR_STEPS = 20
+PROGRESS_BARS = tuple(
+    "▓" * i + "░" * (PROGRESS_BAR_STEPS - i) for i in range(PROGRESS_BAR_STEPS + 1)
+)
+
+def create_progress_bar(percent: Union[int, float]) -> str:
+    """Get the progress bar for a percentage (0-100)"""
+    step = int(percent * PROGRESS_BAR_STEPS / 100)
+    return PROGRESS_BARS[min(PROGRESS_BAR_STEPS, max(0, step))]
+
 def format_timedelta(delta: timedelta) -> str:
     """Format a timedelta as a human-readable string"""
     total_seconds = int(delta.total_seconds())
@@ -48,17 +59,17 @@ def format_price(price: Union[int, float]) -> str:
     """Format price with thousand separators"""
     return f"{int(price):,}"
 
+URL_PATTERN = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
 def is_valid_url(url: str) -> bool:
     """Check if a string is a valid URL"""
-    url_pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    
-    return bool(url_pattern.match(url))
+    return bool(URL_PATTERN.match(url))
 
 def truncate(text: str, max_length: int = 50, ellipsis: str = "...") -> str:
     """Truncate text and add ellipsis if needed"""
@@ -67,6 +78,10 @@ def truncate(text: str, max_length: int = 50, ellipsis: str = "...") -> str:
     
     return text[:max_length - len(ellipsis)] + ellipsis
 
+# Number and optional unit, e.g. "1.5 GB", "700m", "1024"
+SIZE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)\s*([kmgt]?b?)?$')
+SIZE_MULTIPLIERS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
 def parse_human_readable_size(size_str: str) -> Optional[int]:
     """Parse human-readable size string to bytes"""
     if not size_str:
@@ -76,7 +91,7 @@ def parse_human_readable_size(size_str: str) -> Optional[int]:
     size_str = size_str.strip().lower()
     
     # Extract number and unit
-    match = re.match(r'^(\d+(?:\.\d+)?)\s*([kmgt]?b?)?$', size_str)
+    match = SIZE_PATTERN.match(size_str)
     if not match:
         return None
     
@@ -88,7 +103,6 @@ def parse_human_readable_size(size_str: str) -> Optional[int]:
         unit = unit[0]
     
     # Convert to bytes
-    units = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
-    multiplier = units.get(unit.lower(), 1)
+    multiplier = SIZE_MULTIPLIERS.get(unit, 1)
     
     return int(number * multiplier)
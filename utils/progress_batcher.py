@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class ProgressBatcher:
+    """Coalesces progress message edits and flushes them with bounded concurrency"""
+
+    def __init__(self, interval: float = 0.5, max_concurrency: int = 25):
+        """
+        Args:
+            interval: Seconds between flushes
+            max_concurrency: Maximum number of edit requests in flight at once
+                (Telegram allows ~30 messages per second per bot)
+        """
+        self.interval = interval
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending: Dict[Tuple[int, int], Tuple[Any, str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the flush loop on the running event loop if it is not running yet"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, message, text: str, **kwargs):
+        """Queue an edit of `message`; a newer edit replaces any pending one.
+
+        Safe to call from yt-dlp worker threads.
+        """
+        key = (message.chat_id, message.message_id)
+        with self._lock:
+            self._pending[key] = (message, text, kwargs)
+
+    def discard(self, message):
+        """Drop a pending edit, e.g. before the message is finalized or deleted"""
+        with self._lock:
+            self._pending.pop((message.chat_id, message.message_id), None)
+
+    async def flush(self):
+        """Send all pending edits"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        if batch:
+            await asyncio.gather(*(
+                self._edit(message, text, kwargs)
+                for message, text, kwargs in batch.values()
+            ))
+
+    async def _edit(self, message, text: str, kwargs: Dict[str, Any]):
+        async with self._semaphore:
+            try:
+                await message.edit_text(text, **kwargs)
+            except Exception as e:
+                # Progress edits are best-effort (e.g. "message is not modified")
+                logger.debug(f"Progress update failed: {str(e)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+# Shared batcher for all download progress messages
+progress_batcher = ProgressBatcher()